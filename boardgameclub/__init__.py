@@ -12,6 +12,8 @@ app.config['CLIENT_SECRET_FILE'] = os.path.join(
     app.instance_path, 'client_secret.json')
 app.config['CLIENT_ID'] = json.loads(
     open(app.config['CLIENT_SECRET_FILE'], 'r').read())['web']['client_id']
+if app.config['LOG_LEVEL']:
+    app.logger.setLevel(app.config['LOG_LEVEL'])
 
 # Jinja2 globals
 app.jinja_env.globals['client_id'] = app.config['CLIENT_ID']
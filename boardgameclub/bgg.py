@@ -0,0 +1,265 @@
+"""BoardGameGeek XML API2 client.
+
+All requests to BGG go through a single pooled HTTP session with
+keep-alive connections and timeouts. Parsed search and thing responses
+are held in a bounded LRU cache with a time-to-live.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from xml.etree import ElementTree
+import requests
+from flask import g, has_request_context
+from requests.adapters import HTTPAdapter
+from boardgameclub import app
+from boardgameclub.lru import LRUCache
+
+
+class BGGError(Exception):
+    """BGG API is unavailable or returned an unexpected response."""
+
+
+class RateLimiter(object):
+    """Thread-safe limiter spacing out calls evenly in time.
+
+    Args:
+        rate (float): maximum number of calls per second; 0 disables
+            the limiter.
+    """
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        """Block until the next call is allowed."""
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.time()
+            delay = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+class SingleFlight(object):
+    """Coalesce concurrent calls sharing a key into a single call.
+
+    The first caller runs the function; callers arriving while it is
+    running wait for it to finish and receive the same result or error.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func, *args):
+        """Run func(*args) unless a call with the same key is in flight."""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = func(*args)
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+
+class _Call(object):
+    """Call in flight; see SingleFlight."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class BGGClient(object):
+    """Client of the BGG XML API2.
+
+    Args:
+        base_url (str): URL of the API, without trailing slash.
+        timeout (float or tuple): connect and read timeouts in seconds.
+        pool_size (int): maximum number of keep-alive connections.
+        cache_size (int): maximum number of cached responses.
+        cache_ttl (int): lifetime of cached responses in seconds.
+        rate_limit (float): maximum number of requests per second.
+        batch_size (int): maximum number of ids in one thing request.
+    """
+
+    def __init__(self, base_url, timeout, pool_size, cache_size, cache_ttl,
+                 rate_limit=0, batch_size=20):
+        self.base_url = base_url
+        self.timeout = timeout
+        self.batch_size = batch_size
+        self.limiter = RateLimiter(rate_limit)
+        self.flight = SingleFlight()
+        self.cache = LRUCache(cache_size, cache_ttl)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def _get(self, endpoint, params):
+        """Send GET request to the API endpoint; return the parsed XML.
+
+        The request is added to the BGG metrics of the current app
+        request, if any.
+        """
+        url = '{}/{}'.format(self.base_url, endpoint)
+        self.limiter.wait()
+        start = time.time()
+        try:
+            r = self.session.get(url, params=params, timeout=self.timeout)
+            r.raise_for_status()
+            return ElementTree.fromstring(r.content)
+        except (requests.RequestException, ElementTree.ParseError) as e:
+            raise BGGError('BGG request to {} failed: {}'.format(url, e))
+        finally:
+            if has_request_context() and 'bgg_count' in g:
+                g.bgg_count += 1
+                g.bgg_time += time.time() - start
+
+    def search(self, bg_name):
+        """Search for board games by name.
+
+        Args:
+            bg_name (str): game name.
+
+        Returns:
+            List of dictionaries. Each dictionary holds basic info about
+            a game.
+        """
+        key = ('search', bg_name.strip().lower())
+        bgg_games = self.cache.get(key)
+        if bgg_games is None:
+            root = self._get('search', {'query': bg_name,
+                                        'type': 'boardgame'})
+            bgg_games = []
+            for item in root.findall('item'):
+                try:
+                    year = item.find('yearpublished').get('value')
+                except AttributeError:
+                    year = ''
+                bgg_games.append({'id': item.get('id'),
+                                  'name': item.find('name').get('value'),
+                                  'year': year})
+            self.cache.set(key, bgg_games)
+        return [dict(bgg_game) for bgg_game in bgg_games]
+
+    def thing(self, bgg_id, fresh=False):
+        """Get full info on a board game.
+
+        Args:
+            bgg_id (int): game's id on BGG.
+            fresh (bool): bypass the cache and request the game from BGG;
+                the response replaces the cached one.
+
+        Concurrent calls for the same game share a single request.
+
+        Returns:
+            Dictionary with game info; the names of the game categories
+            are held under the 'categories' key.
+        """
+        bgg_id = int(bgg_id)
+        game_info = self.flight.do(('thing', bgg_id, fresh), self.things,
+                                   [bgg_id], fresh).get(bgg_id)
+        if game_info is None:
+            raise BGGError('Game {} not found on BGG'.format(bgg_id))
+        return dict(game_info, categories=list(game_info['categories']))
+
+    def things(self, bgg_ids, fresh=False):
+        """Get full info on many board games.
+
+        Games missing from the cache are requested in batches of up to
+        batch_size ids per request.
+
+        Args:
+            bgg_ids (list): games' ids on BGG.
+            fresh (bool): bypass the cache and request all the games.
+
+        Returns:
+            Dictionary mapping BGG id to dictionary with game info as
+            returned by thing. Ids unknown to BGG are left out.
+        """
+        games_info = {}
+        missing = []
+        for bgg_id in OrderedDict.fromkeys(int(x) for x in bgg_ids):
+            game_info = None if fresh else self.cache.get(('thing', bgg_id))
+            if game_info is None:
+                missing.append(bgg_id)
+            else:
+                games_info[bgg_id] = game_info
+        for i in range(0, len(missing), self.batch_size):
+            batch = missing[i:i + self.batch_size]
+            root = self._get('thing', {
+                'id': ','.join(str(bgg_id) for bgg_id in batch),
+                'stats': 1})
+            for item in root.findall('item'):
+                try:
+                    game_info = parse_thing(item)
+                except (AttributeError, TypeError, ValueError) as e:
+                    raise BGGError('Unexpected BGG response for game {}: {}'
+                                   .format(item.get('id'), e))
+                self.cache.set(('thing', game_info['bgg_id']), game_info)
+                games_info[game_info['bgg_id']] = game_info
+        return dict((bgg_id, dict(game_info,
+                                  categories=list(game_info['categories'])))
+                    for bgg_id, game_info in games_info.iteritems())
+
+    def stats(self):
+        """Return cache statistics."""
+        return {'size': len(self.cache), 'hits': self.cache.hits,
+                'misses': self.cache.misses}
+
+
+def parse_thing(item):
+    """Convert <item> element of BGG thing response to dictionary."""
+    bgg_id = int(item.get('id'))
+    game_info = {'bgg_id': bgg_id}
+    # name
+    for name in item.findall('name'):
+        if name.get('type') == 'primary':
+            game_info['name'] = name.get('value')
+    # image
+    game_info['image'] = item.find('image').text
+    # complexity/weight and bgg_rating
+    ratings = item.find('statistics').find('ratings')
+    game_info['weight'] = ratings.find('averageweight').get('value')
+    game_info['bgg_rating'] = ratings.find('average').get('value')
+    # other properties
+    properties = ['year_published', 'min_age', 'min_playtime', 'max_playtime',
+                  'min_players', 'max_players']
+    for bg_prop in properties:
+        game_info[bg_prop] = item.find(bg_prop.replace('_', '')).get('value')
+    game_info['bgg_link'] = 'https://boardgamegeek.com/boardgame/{}'.format(
+        bgg_id)
+    # categories
+    game_info['categories'] = [
+        link.get('value') for link in item.findall('link')
+        if link.get('type') == 'boardgamecategory']
+    return game_info
+
+
+bgg_client = BGGClient(app.config['BGG_API_URL'],
+                       app.config['BGG_TIMEOUT'],
+                       app.config['BGG_POOL_SIZE'],
+                       app.config['BGG_CACHE_SIZE'],
+                       app.config['BGG_CACHE_TTL'],
+                       app.config['BGG_RATE_LIMIT'],
+                       app.config['BGG_BATCH_SIZE'])
@@ -0,0 +1,207 @@
+"""Caches of API responses and rendered template fragments.
+
+Entries are cached under keys including generations: counters held in
+the database and bumped in the same transaction as every write to the
+data they cover. The catalogue generation covers games, collections,
+users and the club, the posts generation covers posts and the admins
+generation covers admin status. A write therefore makes all the entries
+depending on it unreachable, in every process, as soon as it is
+committed; unreachable entries are evicted in time.
+
+Two interchangeable backends are available, selected with the
+RESULT_CACHE and FRAGMENT_CACHE settings: 'memory' keeps the entries in
+a bounded LRU cache in each process and 'redis' in a Redis server
+shared by all the processes (requires the redis package).
+
+The generations also serve as versions of the pages and API responses
+in their ETags, so conditional requests for unchanged data are answered
+with 304 Not Modified without loading the data.
+"""
+
+import functools
+import hashlib
+import json
+import sqlalchemy
+from flask import request, session, g, has_app_context
+from boardgameclub import app
+from boardgameclub.database import db_session, insert_ignore
+from boardgameclub.lru import LRUCache
+from boardgameclub.models import generations
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+
+class MemoryBackend(object):
+    """Cache held in the memory of the process.
+
+    Args:
+        size (int): maximum number of entries.
+        ttl (int): entry lifetime in seconds.
+    """
+
+    def __init__(self, size, ttl):
+        self.cache = LRUCache(size, ttl)
+
+    def get(self, key):
+        return self.cache.get(key)
+
+    def set(self, key, value):
+        self.cache.set(key, value)
+
+
+class RedisBackend(object):
+    """Cache held in a Redis server shared by all the processes.
+
+    Args:
+        url (str): URL of the Redis server.
+        ttl (int): entry lifetime in seconds.
+    """
+
+    def __init__(self, url, ttl):
+        self.client = redis.StrictRedis.from_url(url)
+        self.ttl = ttl
+
+    def get(self, key):
+        return self.client.get(key)
+
+    def set(self, key, value):
+        self.client.setex(key, self.ttl, value)
+
+
+def make_backend(kind, size, ttl):
+    """Return cache backend of the given kind or None.
+
+    Args:
+        kind (str): 'memory', 'redis' or None.
+        size (int): maximum number of entries; memory backend only.
+        ttl (int): entry lifetime in seconds.
+    """
+    if kind == 'memory':
+        return MemoryBackend(size, ttl)
+    if kind == 'redis':
+        if redis is None:
+            raise RuntimeError('Cache backend is redis but the redis package '
+                               'is not installed')
+        return RedisBackend(app.config['CACHE_REDIS_URL'], ttl)
+    return None
+
+
+result_cache = make_backend(app.config['RESULT_CACHE'],
+                            app.config['RESULT_CACHE_SIZE'],
+                            app.config['RESULT_CACHE_TTL'])
+
+
+def current_generations():
+    """Return dictionary of all the generations, read once per request."""
+    if 'generations' not in g:
+        g.generations = dict(db_session.execute(sqlalchemy.select(
+            [generations.c.name, generations.c.value])).fetchall())
+    return g.generations
+
+
+def bump_generation(name='catalogue'):
+    """Bump the generation within the current transaction.
+
+    To be called by every write changing the data covered by the
+    generation, before the write is committed.
+
+    Args:
+        name (str): 'catalogue', 'posts' or 'admins'.
+
+    Returns:
+        int: the new generation. The generation row stays locked by the
+            transaction until it ends, so the value is not bumped by
+            anyone else in the meantime.
+    """
+    result = db_session.execute(generations.update().where(
+        generations.c.name == name).values(value=generations.c.value + 1))
+    if not result.rowcount:
+        db_session.execute(insert_ignore(generations).values(
+            name=name, value=1))
+    value = db_session.execute(sqlalchemy.select([generations.c.value]).where(
+        generations.c.name == name)).scalar()
+    if has_app_context():
+        g.pop('generations', None)
+        g.setdefault('written_generations', {})[name] = value
+    return value
+
+
+def written_generation(name='catalogue'):
+    """Return the generation set by the last write of the request or
+    None if the request has not bumped it.
+    """
+    return g.get('written_generations', {}).get(name)
+
+
+def cache_key(endpoint, query_dict, generation):
+    """Build cache key from the endpoint, query args and generation.
+
+    Args are normalized: their order, and the order of the values of
+    args given more than once, do not matter.
+    """
+    args = sorted((key, sorted(values))
+                  for key, values in query_dict.iterlists())
+    digest = hashlib.sha1(json.dumps(args)).hexdigest()
+    return 'bgc:{}:{}:{}'.format(endpoint, generation, digest)
+
+
+def cached(view):
+    """Cache JSON responses of the view.
+
+    Only successful responses are cached; streamed responses are not.
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if result_cache is None or request.args.get('format') == 'ndjson':
+            return view(*args, **kwargs)
+        key = cache_key(request.endpoint, request.args,
+                        current_generations().get('catalogue', 0))
+        body = result_cache.get(key)
+        if body is not None:
+            return app.response_class(body, mimetype='application/json')
+        response = app.make_response(view(*args, **kwargs))
+        if response.status_code == 200:
+            result_cache.set(key, response.get_data())
+        return response
+    return wrapper
+
+
+def response_etag():
+    """Return ETag of the response to the current request.
+
+    The ETag covers the endpoint, the view and query args, the
+    generations and the parts of the session the pages depend on: the
+    signed-in user and the csrf token.
+    """
+    args = sorted((key, sorted(values))
+                  for key, values in request.args.iterlists())
+    version = [request.endpoint, sorted(request.view_args.items()), args,
+               sorted(current_generations().items()),
+               session.get('user_id'), session.get('_csrf_token')]
+    return hashlib.sha1(json.dumps(version)).hexdigest()
+
+
+def conditional(view):
+    """Answer conditional GET requests to the view with 304 Not Modified
+    if the data it shows has not changed.
+
+    Pages with pending flash messages are always rendered, so that the
+    messages are shown. Only successful responses are given an ETag.
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if request.method != 'GET' or '_flashes' in session:
+            return view(*args, **kwargs)
+        etag = response_etag()
+        if request.if_none_match.contains(etag):
+            response = app.response_class(status=304)
+            response.set_etag(etag)
+            return response
+        response = app.make_response(view(*args, **kwargs))
+        if response.status_code == 200:
+            response.set_etag(etag)
+        return response
+    return wrapper
@@ -1,6 +1,6 @@
 """Database settings."""
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, inspect
 from sqlalchemy.orm import scoped_session, sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
 from boardgameclub import app
@@ -13,3 +13,46 @@ db_session = scoped_session(sessionmaker(autocommit=False,
 
 Base = declarative_base()
 Base.query = db_session.query_property()
+
+
+def insert_ignore(table):
+    """Return INSERT statement for the table which silently skips rows
+    violating its unique constraints.
+    """
+    if engine.dialect.name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+        return insert(table).on_conflict_do_nothing()
+    elif engine.dialect.name == 'mysql':
+        return table.insert().prefix_with('IGNORE')
+    return table.insert().prefix_with('OR IGNORE')
+
+
+def missing_schema_items():
+    """Compare the database with the model definitions.
+
+    Returns:
+        tuple: list of tables lacking the defined primary key, list of
+            missing indexes and True if the full-text search on game
+            names is missing; tables not yet created are skipped.
+    """
+    from boardgameclub.models import NAME_SEARCH
+    inspector = inspect(engine)
+    existing_tables = inspector.get_table_names()
+    missing_pks = []
+    missing_indexes = []
+    for table in Base.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue
+        pk = inspector.get_pk_constraint(table.name)['constrained_columns']
+        if set(pk) != set(table.primary_key.columns.keys()):
+            missing_pks.append(table)
+        existing = [index['name'] for index in
+                    inspector.get_indexes(table.name)]
+        missing_indexes.extend(index for index in table.indexes
+                               if index.name not in existing)
+    missing_search = False
+    if 'games' in existing_tables and engine.dialect.name in NAME_SEARCH:
+        search_name = NAME_SEARCH[engine.dialect.name][0]
+        missing_search = search_name not in existing_tables + [
+            index['name'] for index in inspector.get_indexes('games')]
+    return missing_pks, missing_indexes, missing_search
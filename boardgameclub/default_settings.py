@@ -6,6 +6,67 @@ class Config(object):
     DB_URL = 'sqlite:///' + pkg_resources.resource_filename(
         'boardgameclub', 'data/bgclub.db')
     APP_URL = 'http://localhost:5000'
+    # Page sizes of the club's page
+    POSTS_PER_PAGE = 20
+    MEMBERS_PER_PAGE = 100
+    GAMES_PER_PAGE = 100
+    # Page sizes of /api/games
+    API_GAMES_LIMIT = 100
+    API_GAMES_MAX_LIMIT = 1000
+    API_GAMES_STREAM_BATCH = 500  # games fetched per round trip
+    # Warn about requests executing more SQL statements; None to disable
+    QUERY_BUDGET = 20
+    # Budgets of the endpoints which exceed QUERY_BUDGET in normal use:
+    # writes fetching, adding or removing games also update the game
+    # categories and the similar-games index
+    QUERY_BUDGETS = {
+        'club_game_add': 40,
+        'club_game_': 40,
+        'profile_game_add': 40,
+        'profile_game_': 40,
+        'game_': 40,
+        'profile_': 60  # deletion removes the orphaned games of the user
+    }
+    LOG_LEVEL = None  # e.g. 'DEBUG'; None leaves the level of Flask
+    # Bearer token letting scrapers read /metrics; None for admins only
+    METRICS_TOKEN = None
+    # Profiler of sampled requests and requests of admins sending X-Profile
+    PROFILER = False
+    PROFILER_SAMPLE_RATE = 0.0  # fraction of requests profiled
+    PROFILER_DIR = 'profiles'  # in the instance folder
+    # Log SQL statements taking longer; None to disable
+    SLOW_QUERY_THRESHOLD = None  # seconds
+    SLOW_QUERY_LOG = 'slow_queries.log'  # in the instance folder
+    # Leave removal of orphaned games after profile deletion to bgc_sweep
+    DEFER_ORPHAN_SWEEP = False
+    GAME_INDEX = False  # in-memory game index for the game finder; needs numpy
+    SIMILAR_GAMES = 10  # most similar games kept for each game
+    # Games of each category compared with a game, nearest in complexity
+    SIMILAR_CANDIDATES = 100
+    # Cache of /api/games and /api/info responses
+    RESULT_CACHE = 'memory'  # 'memory', 'redis' or None to disable
+    RESULT_CACHE_SIZE = 500  # responses per process; memory backend only
+    RESULT_CACHE_TTL = 300  # seconds
+    # Cache of rendered template fragments
+    FRAGMENT_CACHE = 'memory'  # 'memory', 'redis' or None to disable
+    FRAGMENT_CACHE_SIZE = 1000  # fragments per process; memory backend only
+    FRAGMENT_CACHE_TTL = 300  # seconds
+    CACHE_REDIS_URL = 'redis://localhost:6379/0'  # redis backends only
+    # Cache of admin status of users
+    ADMIN_CACHE_SIZE = 1000
+    ADMIN_CACHE_TTL = 300  # seconds
+    # Signing keys of Google id tokens
+    GOOGLE_CERTS_URL = 'https://www.googleapis.com/oauth2/v3/certs'
+    GOOGLE_CERTS_TTL = 3600  # seconds, unless set by Google
+    GOOGLE_TIMEOUT = (3.05, 10)  # connect and read timeouts in seconds
+    # BoardGameGeek API client
+    BGG_API_URL = 'https://boardgamegeek.com/xmlapi2'
+    BGG_TIMEOUT = (3.05, 10)  # connect and read timeouts in seconds
+    BGG_POOL_SIZE = 10
+    BGG_CACHE_SIZE = 1000
+    BGG_CACHE_TTL = 3600  # seconds
+    BGG_RATE_LIMIT = 2  # requests per second; 0 disables the limit
+    BGG_BATCH_SIZE = 20  # ids per thing request
 
 
 class DevelopmentConfig(Config):
@@ -0,0 +1,503 @@
+"""Game filter engine shared by the game finder and /api/games.
+
+Each filter maps a query arg to a condition on the games table. The
+conditions are built from bind parameters, so the SELECT statement for
+a given set of args (the filter shape) is built only once; the cached
+statements are also compiled only once and reuse the prepared
+statements of the database driver.
+
+To add a filter, register a function building its condition:
+
+    @register('year-min')
+    def year_min(value):
+        return Game.year_published >= value
+"""
+
+import re
+from collections import OrderedDict
+import sqlalchemy
+from sqlalchemy import bindparam
+from boardgameclub.database import db_session, engine
+from boardgameclub.models import (Game, clubs_games_assoc, users_games_assoc,
+                                  games_categories_assoc)
+
+
+class FilterError(ValueError):
+    """Query arg has an invalid value."""
+
+
+class GameFilter(object):
+    """Condition on games selected by a query arg.
+
+    Attributes:
+        arg (str): name of the query arg.
+        condition: function building the SQL condition from a bind
+            parameter.
+        kind (str): 'ownership' or 'attribute'; games have to satisfy
+            any of the ownership and all of the attribute conditions.
+        multiple (bool): True if the arg may be given more than once;
+            the condition then receives an expanding bind parameter
+            holding a list of values.
+        convert: function converting the arg value to the parameter
+            value; raises ValueError if the value is invalid.
+        join (tuple): table and ON clause joined to games if the filter
+            is used, or None.
+    """
+
+    def __init__(self, arg, condition, kind, multiple, convert, join):
+        self.arg = arg
+        self.condition = condition
+        self.kind = kind
+        self.multiple = multiple
+        self.convert = convert
+        self.join = join
+        self.param = arg.replace('-', '_')
+
+    def clause(self):
+        """Return SQL condition of the filter."""
+        return self.condition(bindparam(self.param, expanding=self.multiple))
+
+
+def to_int(value):
+    """Convert non-negative integer string to int."""
+    if not value.isdigit():
+        raise ValueError('{} is not a non-negative integer'.format(value))
+    return int(value)
+
+
+# Registry of filters
+FILTERS = OrderedDict()
+
+
+def register(arg, kind='attribute', multiple=False, convert=to_int,
+             join=None):
+    """Register function building the condition of a new filter."""
+    def decorator(condition):
+        FILTERS[arg] = GameFilter(arg, condition, kind, multiple, convert,
+                                  join)
+        return condition
+    return decorator
+
+
+@register('club', kind='ownership')
+def owned_by_club(club_id):
+    return sqlalchemy.exists().where(sqlalchemy.and_(
+        clubs_games_assoc.c.game_id == Game.id,
+        clubs_games_assoc.c.club_id == club_id))
+
+
+@register('user', kind='ownership', multiple=True)
+def owned_by_users(user_ids):
+    return sqlalchemy.exists().where(sqlalchemy.and_(
+        users_games_assoc.c.game_id == Game.id,
+        users_games_assoc.c.user_id.in_(user_ids)))
+
+
+@register('id', multiple=True)
+def game_ids(ids):
+    return Game.id.in_(ids)
+
+
+def nullable_key(column):
+    """Return sort key of the nullable numeric column: the value as
+    stored, without rounding to the scale of the column type, or -1 for
+    NULL.
+
+    NULL never compares equal to or greater than the keyset cursor, so
+    games without the value would be skipped by paging. Sorting them
+    as -1 places them first in ascending order on every dialect.
+    """
+    return sqlalchemy.func.coalesce(
+        sqlalchemy.type_coerce(column, sqlalchemy.Float), -1)
+
+
+# Sort keys made by nullable_key; NULL in their cursors stands for -1
+NULLABLE_SORT_KEYS = ('bgg_rating', 'weight')
+
+
+# Game attributes by which games can be sorted
+SORT_KEYS = {
+    'id': Game.id,
+    'name': Game.name,
+    'year_published': Game.year_published,
+    'bgg_rating': nullable_key(Game.bgg_rating),
+    'weight': nullable_key(Game.weight)
+}
+
+
+def fts_query(value):
+    """Convert game name to FTS5 query matching all its words as
+    prefixes.
+    """
+    words = re.findall(r'\w+', value, re.UNICODE)
+    if not words:
+        raise ValueError('no words to search for')
+    return ' '.join('"{}"*'.format(word) for word in words)
+
+
+# Name search; games matching the name can be sorted by relevance
+if engine.dialect.name == 'sqlite':
+    games_fts = sqlalchemy.table('games_fts', sqlalchemy.column('rowid'),
+                                 sqlalchemy.column('rank', sqlalchemy.Float))
+
+    @register('name', convert=fts_query,
+              join=(games_fts, games_fts.c.rowid == Game.id))
+    def name_matches(query):
+        return sqlalchemy.literal_column('games_fts').match(query)
+
+    # bm25 rank is lower for better matches
+    SORT_KEYS['relevance'] = games_fts.c.rank
+elif engine.dialect.name == 'postgresql':
+    @register('name', convert=lambda value: value.strip())
+    def name_contains(name):
+        return Game.name.ilike(
+            sqlalchemy.literal('%') + name + sqlalchemy.literal('%'))
+
+    SORT_KEYS['relevance'] = -sqlalchemy.func.similarity(
+        Game.name, bindparam('name'))
+else:
+    @register('name', convert=lambda value: value + '%')
+    def name_starts_with(pattern):
+        return Game.name.like(pattern)
+
+    SORT_KEYS['relevance'] = Game.name
+
+
+@register('category', multiple=True)
+def in_categories(category_ids):
+    return sqlalchemy.exists().where(sqlalchemy.and_(
+        games_categories_assoc.c.game_id == Game.id,
+        games_categories_assoc.c.category_id.in_(category_ids)))
+
+
+@register('rating-min')
+def rating_min(value):
+    return Game.bgg_rating >= value
+
+
+@register('players-from')
+def players_from(value):
+    return Game.min_players <= value
+
+
+@register('players-to')
+def players_to(value):
+    return Game.max_players >= value
+
+
+@register('time-from')
+def time_from(value):
+    return Game.max_playtime >= value
+
+
+@register('time-to')
+def time_to(value):
+    return Game.min_playtime <= value
+
+
+@register('weight-min')
+def weight_min(value):
+    return Game.weight >= value
+
+
+@register('weight-max')
+def weight_max(value):
+    return Game.weight <= value
+
+
+# Facets of search results: numbers of players, and upper bounds of
+# the bands of weight and maximum playing time; a value falls in the
+# first band whose bound it does not exceed or, if it exceeds all the
+# bounds, in the last, open band
+PLAYER_COUNTS = range(1, 9)
+WEIGHT_BANDS = (2, 3, 4)
+TIME_BANDS = (30, 60, 120)
+
+
+# SELECT statements by filter shape, sort key and paging
+_statements = {}
+# Compiled forms of the cached statements
+_compiled_cache = {}
+
+
+def parse_args(query_dict):
+    """Convert query args to parameter values of the filters.
+
+    Args with empty values or equal to 'any' and args not matching any
+    filter are skipped.
+
+    Args:
+        query_dict (MultiDict): query args.
+
+    Returns:
+        Dictionary mapping query arg to parameter value or list of
+        values for args which can be given multiple times.
+
+    Raises:
+        FilterError: if any of the values is invalid.
+    """
+    values = {}
+    for arg, game_filter in FILTERS.iteritems():
+        arg_values = [value for value in query_dict.getlist(arg)
+                      if value not in ('', 'any')]
+        if not arg_values:
+            continue
+        if len(arg_values) > 1 and not game_filter.multiple:
+            raise FilterError('{} can be given only once'.format(arg))
+        try:
+            arg_values = [game_filter.convert(value) for value in arg_values]
+        except ValueError as e:
+            raise FilterError('Invalid value of {}: {}'.format(arg, e))
+        values[arg] = arg_values if game_filter.multiple else arg_values[0]
+    return values
+
+
+def where_clause(shape):
+    """Build WHERE clause of the filters in the shape.
+
+    The clause is an intersection of the union of ownership conditions
+    and the attribute conditions.
+
+    Args:
+        shape (tuple): sorted names of the query args.
+    """
+    ownership = [FILTERS[arg].clause() for arg in shape
+                 if FILTERS[arg].kind == 'ownership']
+    conditions = [FILTERS[arg].clause() for arg in shape
+                  if FILTERS[arg].kind == 'attribute']
+    if ownership:
+        conditions.insert(0, sqlalchemy.or_(*ownership))
+    return sqlalchemy.and_(*conditions)
+
+
+def games_statement(shape, sort='id', after=False, limit=False):
+    """Return cached SELECT of games satisfying the filters in the shape.
+
+    Selects all columns of the games table and the sort key as
+    sort_key. Keyset cursor (after_key, after_id) and limit are bind
+    parameters.
+
+    Args:
+        shape (tuple): sorted names of the query args.
+        sort (str): one of SORT_KEYS, prefixed with '-' for descending
+            order. Games with equal sort key are ordered by id.
+        after (bool): skip games up to the cursor.
+        limit (bool): limit the number of games.
+    """
+    key = (shape, sort, after, limit)
+    statement = _statements.get(key)
+    if statement is None:
+        descending = sort.startswith('-')
+        column = SORT_KEYS[sort.lstrip('-')]
+        from_obj = Game.__table__
+        for arg in shape:
+            if FILTERS[arg].join is not None:
+                from_obj = from_obj.join(*FILTERS[arg].join)
+        statement = sqlalchemy.select(
+            [Game.__table__, column.label('sort_key')]).select_from(
+            from_obj).where(where_clause(shape))
+        if after:
+            after_id = bindparam('after_id', type_=sqlalchemy.Integer)
+            if column is Game.id:
+                statement = statement.where(
+                    Game.id < after_id if descending else Game.id > after_id)
+            else:
+                after_key = bindparam('after_key', type_=column.type)
+                statement = statement.where(sqlalchemy.or_(
+                    column < after_key if descending else column > after_key,
+                    sqlalchemy.and_(column == after_key,
+                                    Game.id > after_id)))
+        order = [column.desc() if descending else column]
+        if column is not Game.id:
+            order.append(Game.id)
+        statement = statement.order_by(*order)
+        if limit:
+            statement = statement.limit(bindparam('limit'))
+        # Labels are applied here so that the ORM does not copy the
+        # statement, which would defeat the compiled cache
+        _statements[key] = statement = statement.apply_labels()
+    return statement
+
+
+def band(column, bounds):
+    """Return SQL expression of the band index of the column value;
+    NULL if the value is NULL.
+    """
+    # Constants are rendered inline so that the expression in the GROUP
+    # BY clause is identical to the selected one
+    def inline(value):
+        return sqlalchemy.literal_column(str(value))
+
+    whens = [(column <= inline(bound), inline(i))
+             for i, bound in enumerate(bounds)]
+    whens.append((column > inline(bounds[-1]), inline(len(bounds))))
+    return sqlalchemy.case(whens)
+
+
+def facets_statement(shape):
+    """Return cached statement counting games satisfying the filters in
+    the shape by facet.
+
+    The counts of all the facets are computed by a single statement
+    yielding (facet, value, count) rows, where facet is 'category',
+    'players', 'weight' or 'time' and value is respectively category
+    id, number of players or band index.
+
+    Args:
+        shape (tuple): sorted names of the query args.
+    """
+    key = ('facets', shape)
+    statement = _statements.get(key)
+    if statement is None:
+        from_obj = Game.__table__
+        for arg in shape:
+            if FILTERS[arg].join is not None:
+                from_obj = from_obj.join(*FILTERS[arg].join)
+        matching = sqlalchemy.select(
+            [Game.id, Game.min_players, Game.max_players, Game.weight,
+             Game.max_playtime]).select_from(from_obj).where(
+            where_clause(shape)).alias('matching')
+        players = sqlalchemy.union_all(*[
+            sqlalchemy.select([sqlalchemy.literal_column(str(n)).label('n')])
+            for n in PLAYER_COUNTS]).alias('player_counts')
+        count = sqlalchemy.func.count().label('count')
+
+        def facet(name):
+            return sqlalchemy.literal_column("'{}'".format(name)).label(
+                'facet')
+
+        weight_band = band(matching.c.weight, WEIGHT_BANDS)
+        time_band = band(matching.c.max_playtime, TIME_BANDS)
+        statement = sqlalchemy.union_all(
+            sqlalchemy.select(
+                [facet('category'), games_categories_assoc.c.category_id,
+                 count]).select_from(games_categories_assoc.join(
+                    matching, games_categories_assoc.c.game_id ==
+                    matching.c.id)).group_by(
+                games_categories_assoc.c.category_id),
+            sqlalchemy.select([facet('players'), players.c.n, count])
+            .select_from(matching.join(players, sqlalchemy.and_(
+                matching.c.min_players <= players.c.n,
+                matching.c.max_players >= players.c.n)))
+            .group_by(players.c.n),
+            sqlalchemy.select([facet('weight'), weight_band, count])
+            .group_by(weight_band),
+            sqlalchemy.select([facet('time'), time_band, count])
+            .group_by(time_band))
+        _statements[key] = statement
+    return statement
+
+
+def count_facets(values):
+    """Count games satisfying the filters by facet.
+
+    Args:
+        values (dict): filter values as returned by parse_args.
+
+    Returns:
+        Dictionary mapping facet ('category', 'players', 'weight' or
+        'time') to dictionary mapping category id, number of players or
+        band index to the number of games.
+    """
+    statement = facets_statement(tuple(sorted(values)))
+    facets = dict((name, {}) for name in
+                  ('category', 'players', 'weight', 'time'))
+    for name, value, count in db_session.execute(statement, filter_params(
+            values)):
+        if value is not None:
+            facets[name][int(value)] = count
+    return facets
+
+
+def filter_params(values):
+    """Return bind parameter values of the filters."""
+    return dict((FILTERS[arg].param, value)
+                for arg, value in values.iteritems())
+
+
+def default_sort(values):
+    """Return default sort key: relevance when searching by name, id
+    otherwise.
+    """
+    return 'relevance' if 'name' in values else 'id'
+
+
+def valid_cursor(sort, after):
+    """Check that the cursor suits the sort key.
+
+    Args:
+        sort (str): sort key, optionally prefixed with '-'.
+        after (list): sort key and id of the last game of the previous
+            page.
+
+    Returns:
+        bool: True if the id is an integer and the sort key is a string
+            for string sort keys and a number otherwise (or null for
+            NULLABLE_SORT_KEYS).
+    """
+    key, game_id = after
+    if type(game_id) not in (int, long):
+        return False
+    sort = sort.lstrip('-')
+    if isinstance(SORT_KEYS[sort].type, sqlalchemy.String):
+        return isinstance(key, basestring)
+    if key is None:
+        return sort in NULLABLE_SORT_KEYS
+    return type(key) in (int, long, float)
+
+
+def search_statement(values, sort='id', after=None, limit=None):
+    """Return cached SELECT of games satisfying the filters and the
+    values of its bind parameters.
+
+    Args:
+        values (dict): filter values as returned by parse_args.
+        sort (str): see games_statement.
+        after (list): sort key and id of the last game of the previous
+            page or None.
+        limit (int): maximum number of games or None.
+    """
+    statement = games_statement(tuple(sorted(values)), sort,
+                                after is not None, limit is not None)
+    params = filter_params(values)
+    if after is not None:
+        params['after_key'], params['after_id'] = after
+        if params['after_key'] is None:
+            params['after_key'] = -1
+    if limit is not None:
+        params['limit'] = limit
+    return statement, params
+
+
+def search_games(values, sort='id', after=None, limit=None):
+    """Query games satisfying the filters.
+
+    Args:
+        See search_statement.
+
+    Returns:
+        Query yielding (Game, sort_key) tuples.
+    """
+    statement, params = search_statement(values, sort, after, limit)
+    return (db_session.query(Game, sqlalchemy.column('sort_key'))
+            .from_statement(statement).params(params)
+            .execution_options(compiled_cache=_compiled_cache))
+
+
+def search_rows(values, sort='id', after=None, limit=None, stream=False):
+    """Select games satisfying the filters as plain rows, without
+    loading Game objects.
+
+    Args:
+        stream (bool): fetch the rows from the database in batches as
+            they are consumed, where the driver supports it.
+        Other args: see search_statement.
+
+    Returns:
+        ResultProxy yielding rows with the columns of the games table,
+        accessed by the Column objects of Game.__table__, and sort_key.
+    """
+    statement, params = search_statement(values, sort, after, limit)
+    connection = db_session.connection().execution_options(
+        compiled_cache=_compiled_cache, stream_results=stream)
+    return connection.execute(statement, params)
@@ -0,0 +1,69 @@
+"""Cache of rendered template fragments.
+
+Parts of the pages expensive to build, such as games tables, member
+lists and post feeds, are wrapped in the cache tag:
+
+    {% cache 'members', members_after %}
+      ...
+    {% endcache %}
+
+The rendered fragment is cached under the values given to the tag and
+the current generations (see cache), so it is rendered again after
+every write to the data it shows. Data shown in the fragment should be
+loaded within the tag, so that it is not loaded at all when the
+fragment is found in the cache.
+
+Fragments are shared by all the viewers: anything depending on the
+viewer must either be given to the tag or be kept outside the fragment.
+The same holds for the request, e.g. links to further pages must be
+built from the query args given to the tag only.
+"""
+
+import hashlib
+import json
+from jinja2 import nodes
+from jinja2.ext import Extension
+from markupsafe import Markup
+from boardgameclub import app
+from boardgameclub.cache import make_backend, current_generations
+
+
+fragment_cache = make_backend(app.config['FRAGMENT_CACHE'],
+                              app.config['FRAGMENT_CACHE_SIZE'],
+                              app.config['FRAGMENT_CACHE_TTL'])
+
+
+def fragment_key(parts):
+    """Build cache key from the values given to the tag and the current
+    generations.
+    """
+    key = [parts, sorted(current_generations().items())]
+    digest = hashlib.sha1(json.dumps(key)).hexdigest()
+    return 'bgc:fragment:{}'.format(digest)
+
+
+class FragmentCacheExtension(Extension):
+    """Jinja extension adding the cache tag."""
+
+    tags = set(['cache'])
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        parts = [parser.parse_expression()]
+        while parser.stream.skip_if('comma'):
+            parts.append(parser.parse_expression())
+        body = parser.parse_statements(['name:endcache'], drop_needle=True)
+        call = self.call_method('_render', [nodes.List(parts)])
+        return nodes.CallBlock(call, [], [], body).set_lineno(lineno)
+
+    def _render(self, parts, caller):
+        """Return the cached fragment or render and cache it."""
+        if fragment_cache is None:
+            return caller()
+        key = fragment_key(parts)
+        html = fragment_cache.get(key)
+        if html is not None:
+            return Markup(html.decode('utf-8'))
+        html = caller()
+        fragment_cache.set(key, html.encode('utf-8'))
+        return html
@@ -0,0 +1,405 @@
+"""In-memory columnar index of the games for the game finder and the
+game-night planner.
+
+The numeric game attributes are held in NumPy arrays, one slot per
+game, and membership of the games in each category and in the
+collection of each user and the club as boolean arrays over the same
+slots. Searches by the range, category and ownership filters are then
+answered with vectorized comparisons, without a database query.
+
+The index is optional: it requires NumPy and is enabled with the
+GAME_INDEX setting. It is built on first use and kept up to date by
+the views adding, updating and removing games. The index lives in the
+process of the app and records the catalogue generation (see cache) it
+reflects; it is rebuilt on the next search once the generation has
+been bumped by a write it has not seen, e.g. by another process of the
+app or a command line tool.
+"""
+
+import threading
+import sqlalchemy
+from boardgameclub import app, filters
+from boardgameclub.cache import current_generations, written_generation
+from boardgameclub.database import db_session
+from boardgameclub.models import (Game, games_categories_assoc,
+                                  users_games_assoc, clubs_games_assoc)
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# Columns held in the index
+COLUMNS = ('min_players', 'max_players', 'min_playtime', 'max_playtime',
+           'weight', 'bgg_rating')
+
+
+def _nan_if_none(value):
+    """Convert NULL column value to NaN, which fails every comparison."""
+    return numpy.nan if value is None else float(value)
+
+
+class GameIndex(object):
+    """Columnar index of the games.
+
+    Removed games leave unused slots behind; the arrays are compacted
+    once more than half of the slots are unused.
+
+    Attributes:
+        loaded (bool): True if the index has been built.
+        generation (int): catalogue generation reflected by the index.
+    """
+
+    # Filters answered by the index; see filters.FILTERS
+    FILTERS = frozenset(['club', 'user', 'id', 'category', 'rating-min',
+                         'players-from', 'players-to', 'time-from', 'time-to',
+                         'weight-min', 'weight-max'])
+
+    def __init__(self):
+        self.loaded = False
+        self.generation = None
+        self._lock = threading.Lock()
+        self._clear(16)
+
+    def _clear(self, capacity):
+        """Allocate empty arrays with the given number of slots."""
+        self._size = 0
+        self._ids = numpy.zeros(capacity, dtype=numpy.int64)
+        self._alive = numpy.zeros(capacity, dtype=bool)
+        self._columns = dict((name, numpy.full(capacity, numpy.nan))
+                             for name in COLUMNS)
+        self._categories = {}
+        # Collections by owner: ('user', user_id) or ('club', club_id)
+        self._owners = {}
+        self._slots = {}
+
+    def _masks(self):
+        """Return dictionaries of category and collection masks."""
+        return self._categories, self._owners
+
+    def _grow(self):
+        """Double the number of slots."""
+        capacity = 2 * len(self._ids)
+
+        def resize(array):
+            new_array = numpy.zeros(capacity, dtype=array.dtype)
+            if array.dtype.kind == 'f':
+                new_array.fill(numpy.nan)
+            new_array[:self._size] = array[:self._size]
+            return new_array
+
+        self._ids = resize(self._ids)
+        self._alive = resize(self._alive)
+        for name in COLUMNS:
+            self._columns[name] = resize(self._columns[name])
+        for masks in self._masks():
+            for key in masks:
+                masks[key] = resize(masks[key])
+
+    def _put(self, game_id, values, category_ids):
+        """Store the game in its slot or in a new slot at the end."""
+        slot = self._slots.get(game_id)
+        if slot is None:
+            if self._size == len(self._ids):
+                self._grow()
+            slot = self._slots[game_id] = self._size
+            self._size += 1
+            self._ids[slot] = game_id
+            self._alive[slot] = True
+        for name in COLUMNS:
+            self._columns[name][slot] = _nan_if_none(values[name])
+        for category_id, members in self._categories.iteritems():
+            members[slot] = category_id in category_ids
+        for category_id in category_ids:
+            if category_id not in self._categories:
+                members = numpy.zeros(len(self._ids), dtype=bool)
+                members[slot] = True
+                self._categories[category_id] = members
+
+    def _own(self, owner, game_id, owned):
+        """Set or clear the game's slot in the owner's collection."""
+        slot = self._slots.get(game_id)
+        if slot is None:
+            return
+        members = self._owners.get(owner)
+        if members is None:
+            if not owned:
+                return
+            members = self._owners[owner] = numpy.zeros(len(self._ids),
+                                                        dtype=bool)
+        members[slot] = owned
+
+    def load(self):
+        """Build the index from the database."""
+        # Read before the data, so that the index is at least as recent
+        generation = current_generations().get('catalogue', 0)
+        games = Game.__table__
+        rows = db_session.execute(sqlalchemy.select(
+            [games.c.id] + [games.c[name] for name in COLUMNS])).fetchall()
+        game_categories = {}
+        for game_id, category_id in db_session.execute(sqlalchemy.select(
+                [games_categories_assoc.c.game_id,
+                 games_categories_assoc.c.category_id])):
+            game_categories.setdefault(game_id, set()).add(category_id)
+        ownership = []
+        for kind, table, owner_id in [
+                ('user', users_games_assoc, users_games_assoc.c.user_id),
+                ('club', clubs_games_assoc, clubs_games_assoc.c.club_id)]:
+            ownership.extend(((kind, row[0]), row[1]) for row in
+                             db_session.execute(sqlalchemy.select(
+                                 [owner_id, table.c.game_id])))
+        with self._lock:
+            self._clear(max(16, len(rows)))
+            for row in rows:
+                self._put(row.id, row, game_categories.get(row.id, ()))
+            for owner, game_id in ownership:
+                self._own(owner, game_id, True)
+            self.generation = generation
+            self.loaded = True
+
+    def _refresh(self):
+        """Build the index unless it reflects the current generation."""
+        if (not self.loaded or
+                current_generations().get('catalogue', 0) != self.generation):
+            self.load()
+
+    def _advance(self):
+        """Record the generation set by the write of the request.
+
+        To be called with the lock held by the methods applying the
+        write to the index. The write is applied only if the index was
+        current before it; otherwise the index is left to be rebuilt.
+
+        Returns:
+            bool: True if the write is to be applied.
+        """
+        generation = written_generation()
+        if generation is not None and self.generation in (generation - 1,
+                                                          generation):
+            self.generation = generation
+            return True
+        self.loaded = False
+        return False
+
+    def update(self, game):
+        """Add the game to the index or update its entry.
+
+        Args:
+            game (Game): game with its current attributes and categories.
+        """
+        if not self.loaded:
+            return
+        values = dict((name, getattr(game, name)) for name in COLUMNS)
+        category_ids = set(category.id for category in game.categories)
+        with self._lock:
+            if self._advance():
+                self._put(game.id, values, category_ids)
+
+    def add_owner(self, owner, game_id):
+        """Add the game to the owner's collection.
+
+        Args:
+            owner (tuple): ('user', user_id) or ('club', club_id).
+            game_id (int): id of the game, already in the index.
+        """
+        if not self.loaded:
+            return
+        with self._lock:
+            if self._advance():
+                self._own(owner, game_id, True)
+
+    def remove_owner(self, owner, game_id=None):
+        """Remove the game or all the games from the owner's collection.
+
+        Args:
+            owner (tuple): ('user', user_id) or ('club', club_id).
+            game_id (int): id of the game or None to drop the whole
+                collection.
+        """
+        if not self.loaded:
+            return
+        with self._lock:
+            if not self._advance():
+                return
+            if game_id is None:
+                self._owners.pop(owner, None)
+            else:
+                self._own(owner, game_id, False)
+
+    def remove(self, game_ids):
+        """Remove the games from the index.
+
+        Args:
+            game_ids (list): ids of the removed games.
+        """
+        if not self.loaded:
+            return
+        with self._lock:
+            if not self._advance():
+                return
+            for game_id in game_ids:
+                slot = self._slots.pop(game_id, None)
+                if slot is None:
+                    continue
+                self._alive[slot] = False
+                for masks in self._masks():
+                    for members in masks.itervalues():
+                        members[slot] = False
+            if 2 * len(self._slots) < self._size:
+                self._compact()
+
+    def _compact(self):
+        """Move the games to consecutive slots at the start."""
+        keep = numpy.flatnonzero(self._alive[:self._size])
+        size = len(keep)
+        self._ids[:size] = self._ids[keep]
+        self._alive[:size] = True
+        self._alive[size:] = False
+        for name in COLUMNS:
+            self._columns[name][:size] = self._columns[name][keep]
+        for masks in self._masks():
+            for key in masks.keys():
+                members = masks[key]
+                members[:size] = members[keep]
+                members[size:] = False
+                if not members.any():
+                    del masks[key]
+        self._size = size
+        self._slots = dict((game_id, slot) for slot, game_id
+                           in enumerate(self._ids[:size].tolist()))
+
+    def _match(self, values):
+        """Return mask of the slots of the games satisfying the filters.
+
+        Must be called with the lock held.
+        """
+        size = self._size
+        columns = dict((name, column[:size])
+                       for name, column in self._columns.iteritems())
+        mask = self._alive[:size].copy()
+        owners = [('user', user_id) for user_id in values.get('user', [])]
+        if 'club' in values:
+            owners.append(('club', values['club']))
+        if owners:
+            mask &= self._any_mask(self._owners, owners, size)
+        if 'id' in values:
+            mask &= numpy.in1d(self._ids[:size], values['id'])
+        if 'category' in values:
+            mask &= self._any_mask(self._categories, values['category'],
+                                   size)
+        with numpy.errstate(invalid='ignore'):
+            if 'rating-min' in values:
+                mask &= columns['bgg_rating'] >= values['rating-min']
+            if 'players-from' in values:
+                mask &= columns['min_players'] <= values['players-from']
+            if 'players-to' in values:
+                mask &= columns['max_players'] >= values['players-to']
+            if 'time-from' in values:
+                mask &= columns['max_playtime'] >= values['time-from']
+            if 'time-to' in values:
+                mask &= columns['min_playtime'] <= values['time-to']
+            if 'weight-min' in values:
+                mask &= columns['weight'] >= values['weight-min']
+            if 'weight-max' in values:
+                mask &= columns['weight'] <= values['weight-max']
+        return mask
+
+    def search(self, values):
+        """Return ids of the games satisfying the filters.
+
+        Args:
+            values (dict): filter values as returned by
+                filters.parse_args; all the filters must be in FILTERS.
+
+        Returns:
+            Sorted list of game ids.
+        """
+        self._refresh()
+        with self._lock:
+            mask = self._match(values)
+            return sorted(self._ids[:self._size][mask].tolist())
+
+    def count_facets(self, values):
+        """Count games satisfying the filters by facet.
+
+        Args:
+            values (dict): see search.
+
+        Returns:
+            Dictionary of counts as returned by filters.count_facets.
+        """
+        self._refresh()
+        with self._lock:
+            mask = self._match(values)
+            size = self._size
+            facets = {'category': {}, 'players': {}}
+            for category_id, members in self._categories.iteritems():
+                count = numpy.count_nonzero(members[:size] & mask)
+                if count:
+                    facets['category'][category_id] = count
+            min_players = self._columns['min_players'][:size][mask]
+            max_players = self._columns['max_players'][:size][mask]
+            with numpy.errstate(invalid='ignore'):
+                for n in filters.PLAYER_COUNTS:
+                    count = numpy.count_nonzero((min_players <= n) &
+                                                (max_players >= n))
+                    if count:
+                        facets['players'][n] = count
+            for name, column, bounds in [
+                    ('weight', 'weight', filters.WEIGHT_BANDS),
+                    ('time', 'max_playtime', filters.TIME_BANDS)]:
+                column = self._columns[column][:size][mask]
+                column = column[~numpy.isnan(column)]
+                counts = numpy.bincount(
+                    numpy.searchsorted(bounds, column, side='left'),
+                    minlength=len(bounds) + 1)
+                facets[name] = dict((band, int(count)) for band, count
+                                    in enumerate(counts) if count)
+            return facets
+
+    def owners(self, game_ids, owners):
+        """Return which of the owners own each of the games.
+
+        Args:
+            game_ids (list): ids of games in the index.
+            owners (list): ('user', user_id) and ('club', club_id) tuples.
+
+        Returns:
+            Dictionary mapping game id to list of its owners.
+        """
+        self._refresh()
+        game_owners = dict((game_id, []) for game_id in game_ids)
+        with self._lock:
+            # Skip games removed since they were found
+            game_ids = [game_id for game_id in game_ids
+                        if game_id in self._slots]
+            if not game_ids:
+                return game_owners
+            slots = [self._slots[game_id] for game_id in game_ids]
+            for owner in owners:
+                members = self._owners.get(owner)
+                if members is None:
+                    continue
+                for game_id in numpy.asarray(game_ids)[members[slots]]:
+                    game_owners[int(game_id)].append(owner)
+            return game_owners
+
+    @staticmethod
+    def _any_mask(masks, keys, size):
+        """Return union of the masks with the given keys."""
+        union = numpy.zeros(size, dtype=bool)
+        for key in keys:
+            members = masks.get(key)
+            if members is not None:
+                union |= members[:size]
+        return union
+
+    def covers(self, values):
+        """Return True if the index can answer the filters."""
+        return self.FILTERS.issuperset(values)
+
+
+# Index used by the views; None if disabled or NumPy is missing
+game_index = (GameIndex() if app.config['GAME_INDEX'] and numpy is not None
+              else None)
@@ -0,0 +1,174 @@
+"""Local verification of Google id tokens.
+
+Id tokens are JSON Web Tokens signed by Google with RS256. Their
+signatures are verified against Google's public signing keys (JWKS),
+which are fetched once and cached for as long as Google allows, so
+verifying a token does not need a request to Google. User data is then
+taken from the claims of the verified token.
+"""
+
+import base64
+import json
+import threading
+import time
+import requests
+import rsa
+from boardgameclub import app
+
+
+# Issuers of Google id tokens
+ISSUERS = ('https://accounts.google.com', 'accounts.google.com')
+
+# Minimum interval between refreshes of the keys forced by tokens signed
+# with an unknown key, in seconds
+MIN_REFRESH_INTERVAL = 60
+
+
+class TokenError(ValueError):
+    """Id token is malformed, wrongly signed, expired or not meant for
+    the app.
+    """
+
+
+def b64decode(data):
+    """Decode unpadded base64url data as used in JWTs."""
+    data = str(data)
+    try:
+        return base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))
+    except TypeError:
+        raise TokenError('Invalid base64 data')
+
+
+def b64_to_int(data):
+    """Decode unpadded base64url big-endian integer."""
+    return int(b64decode(data).encode('hex') or '0', 16)
+
+
+def public_keys(jwks):
+    """Convert JWK set to dictionary mapping key id to rsa.PublicKey."""
+    return dict((key['kid'], rsa.PublicKey(b64_to_int(key['n']),
+                                           b64_to_int(key['e'])))
+                for key in jwks['keys']
+                if key.get('kty') == 'RSA' and 'kid' in key)
+
+
+def max_age(response, default):
+    """Return lifetime of the response given by its Cache-Control header
+    or the default.
+    """
+    for directive in response.headers.get('Cache-Control', '').split(','):
+        name, _, value = directive.strip().partition('=')
+        if name == 'max-age' and value.isdigit():
+            return int(value)
+    return default
+
+
+class SigningKeys(object):
+    """Cache of the public signing keys of Google.
+
+    Args:
+        url (str): URL of the JWK set.
+        ttl (int): lifetime of the keys in seconds if the response
+            does not specify it.
+        timeout (float or tuple): connect and read timeouts in seconds.
+    """
+
+    def __init__(self, url, ttl, timeout=None):
+        self.url = url
+        self.ttl = ttl
+        self.timeout = timeout
+        self._keys = {}
+        self._expires = 0
+        self._fetched = 0
+        self._lock = threading.Lock()
+
+    def set_keys(self, keys, ttl):
+        """Store the keys for ttl seconds.
+
+        Args:
+            keys (dict): key id to rsa.PublicKey, see public_keys.
+            ttl (int): lifetime of the keys in seconds.
+        """
+        with self._lock:
+            self._keys = keys
+            self._fetched = time.time()
+            self._expires = self._fetched + ttl
+
+    def refresh(self):
+        """Fetch the keys from Google."""
+        try:
+            response = requests.get(self.url, timeout=self.timeout)
+            response.raise_for_status()
+            keys = public_keys(response.json())
+        except (requests.RequestException, ValueError, KeyError) as e:
+            raise TokenError('Failed to fetch signing keys: {}'.format(e))
+        self.set_keys(keys, max_age(response, self.ttl))
+
+    def get(self, kid):
+        """Return the key with the given id.
+
+        The keys are fetched if they have expired or if the key is
+        unknown, as Google rotates its keys, but not more often than
+        every MIN_REFRESH_INTERVAL seconds for unknown keys.
+
+        Raises:
+            TokenError: the key is unknown.
+        """
+        now = time.time()
+        if now >= self._expires or (
+                kid not in self._keys and
+                now - self._fetched >= MIN_REFRESH_INTERVAL):
+            self.refresh()
+        key = self._keys.get(kid)
+        if key is None:
+            raise TokenError('Unknown signing key')
+        return key
+
+
+def verify_id_token(token, audience, keys):
+    """Verify signature and claims of the id token.
+
+    Args:
+        token (str): id token as a JWT.
+        audience (str): client id of the app.
+        keys (SigningKeys): signing keys of the issuer.
+
+    Returns:
+        Dictionary of the claims of the token.
+
+    Raises:
+        TokenError: the token is not valid.
+    """
+    try:
+        header_b64, claims_b64, signature_b64 = str(token).split('.')
+        header = json.loads(b64decode(header_b64))
+        claims = json.loads(b64decode(claims_b64))
+    except ValueError:
+        raise TokenError('Malformed token')
+    if not isinstance(header, dict) or not isinstance(claims, dict):
+        raise TokenError('Malformed token')
+    if header.get('alg') != 'RS256':
+        raise TokenError('Unsupported signing algorithm')
+    key = keys.get(header.get('kid'))
+    try:
+        method = rsa.verify('{}.{}'.format(header_b64, claims_b64),
+                            b64decode(signature_b64), key)
+    except rsa.VerificationError:
+        raise TokenError('Invalid signature')
+    if method != 'SHA-256':
+        raise TokenError('Unsupported signing algorithm')
+    if claims.get('iss') not in ISSUERS:
+        raise TokenError('Token not issued by Google')
+    if claims.get('aud') != audience:
+        raise TokenError('Token not meant for the app')
+    if not isinstance(claims.get('exp'), (int, long)) or (
+            claims['exp'] <= time.time()):
+        raise TokenError('Token expired')
+    if 'email' not in claims:
+        raise TokenError('Token without email')
+    return claims
+
+
+google_keys = SigningKeys(app.config['GOOGLE_CERTS_URL'],
+                          app.config['GOOGLE_CERTS_TTL'],
+                          app.config['GOOGLE_TIMEOUT'])
@@ -0,0 +1,56 @@
+"""Bounded in-process cache shared by the BGG client, the result and
+fragment caches and the admin-status cache.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """Thread-safe LRU cache with per-entry time-to-live.
+
+    Attributes:
+        max_size (int): maximum number of entries held in the cache.
+        ttl (int): entry lifetime in seconds.
+        hits (int): number of successful lookups.
+        misses (int): number of lookups of missing or expired entries.
+    """
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return the cached value or None if missing or expired."""
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is None or entry[0] < time.time():
+                self.misses += 1
+                return None
+            # Re-insert to mark the entry as most recently used
+            self._data[key] = entry
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        """Store value; evict the least recently used entry if full."""
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (time.time() + self.ttl, value)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        """Remove all entries and reset the counters."""
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def __len__(self):
+        return len(self._data)
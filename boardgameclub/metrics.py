@@ -0,0 +1,110 @@
+"""Performance metrics of the app in the Prometheus text format.
+
+Requests are measured per endpoint: wall time, number and time of SQL
+statements, template render time and number and time of requests to
+the BGG API. Metrics are held in the memory of each process of the
+app and served at /metrics; see views.
+"""
+
+import bisect
+import threading
+
+
+# Upper bounds of the buckets of the histograms, by unit
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+
+class Histogram(object):
+    """Histogram of observed values, optionally with a label.
+
+    Args:
+        name (str): name of the metric.
+        description (str): help text of the metric.
+        buckets (tuple): sorted upper bounds of the buckets.
+        label (str): name of the label or None.
+    """
+
+    def __init__(self, name, description, buckets, label=None):
+        self.name = name
+        self.description = description
+        self.buckets = buckets
+        self.label = label
+        # Label value to [bucket counts, sum, count]
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, label_value=None):
+        """Record the value."""
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_value)
+            if series is None:
+                series = self._series[label_value] = [
+                    [0] * (len(self.buckets) + 1), 0, 0]
+            series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def _labels(self, label_value, le=None):
+        """Format labels of a sample."""
+        labels = []
+        if self.label is not None:
+            labels.append('{}="{}"'.format(self.label, escape(label_value)))
+        if le is not None:
+            labels.append('le="{}"'.format(le))
+        return '{{{}}}'.format(','.join(labels)) if labels else ''
+
+    def expose(self):
+        """Return the histogram in the Prometheus text format."""
+        lines = ['# HELP {} {}'.format(self.name, self.description),
+                 '# TYPE {} histogram'.format(self.name)]
+        with self._lock:
+            series = sorted((label_value, [list(counts), total, count])
+                            for label_value, (counts, total, count)
+                            in self._series.iteritems())
+        for label_value, (counts, total, count) in series:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += bucket_count
+                lines.append('{}_bucket{} {}'.format(
+                    self.name, self._labels(label_value, bound), cumulative))
+            lines.append('{}_sum{} {!r}'.format(
+                self.name, self._labels(label_value), total))
+            lines.append('{}_count{} {}'.format(
+                self.name, self._labels(label_value), count))
+        return '\n'.join(lines) + '\n'
+
+
+def escape(value):
+    """Escape label value for the Prometheus text format."""
+    return (unicode(value).replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n').encode('utf-8'))
+
+
+request_seconds = Histogram(
+    'bgc_request_seconds', 'Wall time of requests.', SECONDS_BUCKETS,
+    'endpoint')
+sql_statements = Histogram(
+    'bgc_sql_statements', 'Number of SQL statements executed by requests.',
+    COUNT_BUCKETS, 'endpoint')
+sql_seconds = Histogram(
+    'bgc_sql_seconds', 'Time spent executing SQL statements by requests.',
+    SECONDS_BUCKETS, 'endpoint')
+render_seconds = Histogram(
+    'bgc_template_render_seconds', 'Template render time of requests.',
+    SECONDS_BUCKETS, 'endpoint')
+bgg_requests = Histogram(
+    'bgc_bgg_requests', 'Number of requests to the BGG API made by requests.',
+    COUNT_BUCKETS, 'endpoint')
+bgg_seconds = Histogram(
+    'bgc_bgg_seconds', 'Time spent in requests to the BGG API by requests '
+    'making any.', SECONDS_BUCKETS, 'endpoint')
+
+HISTOGRAMS = (request_seconds, sql_statements, sql_seconds, render_seconds,
+              bgg_requests, bgg_seconds)
+
+
+def expose():
+    """Return all the metrics in the Prometheus text format."""
+    return ''.join(histogram.expose() for histogram in HISTOGRAMS)
@@ -1,6 +1,7 @@
 """SQLAlchemy model and table definitions."""
 
-from sqlalchemy import Table, Column, ForeignKey, Integer, String, Numeric
+from sqlalchemy import (Table, Column, ForeignKey, Integer, String, Numeric,
+                        Float, event)
 from sqlalchemy.orm import relationship
 from boardgameclub.database import Base
 
@@ -8,24 +9,48 @@ from boardgameclub.database import Base
 users_games_assoc = Table(
     'users_games',
     Base.metadata,
-    Column('user_id', Integer, ForeignKey('users.id')),
-    Column('game_id', Integer, ForeignKey('games.id'))
+    Column('user_id', Integer, ForeignKey('users.id'), primary_key=True),
+    Column('game_id', Integer, ForeignKey('games.id'), primary_key=True,
+           index=True)
 )
 
 
 clubs_games_assoc = Table(
     'clubs_games',
     Base.metadata,
-    Column('club_id', Integer, ForeignKey('clubs.id')),
-    Column('game_id', Integer, ForeignKey('games.id'))
+    Column('club_id', Integer, ForeignKey('clubs.id'), primary_key=True),
+    Column('game_id', Integer, ForeignKey('games.id'), primary_key=True,
+           index=True)
 )
 
 
 games_categories_assoc = Table(
     'games_categories',
     Base.metadata,
-    Column('game_id', Integer, ForeignKey('games.id')),
-    Column('category_id', Integer, ForeignKey('game_categories.id'))
+    Column('game_id', Integer, ForeignKey('games.id'), primary_key=True),
+    Column('category_id', Integer, ForeignKey('game_categories.id'),
+           primary_key=True, index=True)
+)
+
+
+# Most similar games of each game; see boardgameclub.similar
+similar_games_assoc = Table(
+    'similar_games',
+    Base.metadata,
+    Column('game_id', Integer, ForeignKey('games.id'), primary_key=True),
+    Column('similar_id', Integer, ForeignKey('games.id'), primary_key=True,
+           index=True),
+    Column('score', Float, nullable=False)
+)
+
+
+# Counters bumped by writes, e.g. the catalogue generation; see
+# boardgameclub.cache
+generations = Table(
+    'generations',
+    Base.metadata,
+    Column('name', String(20), primary_key=True),
+    Column('value', Integer, nullable=False)
 )
 
 
@@ -42,13 +67,15 @@ class User(Base):
     """
     __tablename__ = 'users'
     id = Column(Integer, primary_key=True)
-    email = Column(String(80), nullable=False)
+    email = Column(String(80), nullable=False, index=True, unique=True)
     name = Column(String(80), nullable=False)
     about = Column(String(1000))
     picture = Column(String(250))
+    # Rows of users_games are deleted explicitly on user deletion
     games = relationship("Game",
                          secondary=users_games_assoc,
-                         back_populates="users")
+                         back_populates="users",
+                         passive_deletes=True)
     posts = relationship("Post",
                          cascade="all, delete-orphan",
                          back_populates="author")
@@ -88,7 +115,7 @@ class Game(Base):
     min_players = Column(Integer)
     max_players = Column(Integer)
     bgg_rating = Column(Numeric(4, 3))
-    bgg_id = Column(Integer)
+    bgg_id = Column(Integer, index=True, unique=True)
     bgg_link = Column(String(250))
     categories = relationship("GameCategory",
                               secondary=games_categories_assoc,
@@ -101,6 +128,40 @@ class Game(Base):
                          back_populates="games")
 
 
+# Full-text search on game names, by dialect: name of the search table or
+# index and DDL creating it. On SQLite an FTS5 table is kept in sync with
+# games.name by triggers; on PostgreSQL a trigram index serves ILIKE.
+NAME_SEARCH = {
+    'sqlite': ('games_fts', [
+        "CREATE VIRTUAL TABLE games_fts USING fts5(name, content='games', "
+        "content_rowid='id', tokenize='unicode61 remove_diacritics 2')",
+        "CREATE TRIGGER games_fts_insert AFTER INSERT ON games BEGIN "
+        "INSERT INTO games_fts(rowid, name) VALUES (new.id, new.name); END",
+        "CREATE TRIGGER games_fts_delete AFTER DELETE ON games BEGIN "
+        "INSERT INTO games_fts(games_fts, rowid, name) "
+        "VALUES ('delete', old.id, old.name); END",
+        "CREATE TRIGGER games_fts_update AFTER UPDATE OF name ON games BEGIN "
+        "INSERT INTO games_fts(games_fts, rowid, name) "
+        "VALUES ('delete', old.id, old.name); "
+        "INSERT INTO games_fts(rowid, name) VALUES (new.id, new.name); END",
+        "INSERT INTO games_fts(games_fts) VALUES ('rebuild')"
+    ]),
+    'postgresql': ('ix_games_name_trgm', [
+        "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+        "CREATE INDEX ix_games_name_trgm ON games "
+        "USING gin (name gin_trgm_ops)"
+    ])
+}
+
+
+@event.listens_for(Game.__table__, 'after_create')
+def create_name_search(target, connection, **kw):
+    """Create full-text search on game names if the dialect supports it."""
+    name, statements = NAME_SEARCH.get(connection.dialect.name, (None, []))
+    for statement in statements:
+        connection.execute(statement)
+
+
 class GameCategory(Base):
     """This class defines attributes of game-category and metadata of
     the table to which this class is mapped.
@@ -111,7 +172,7 @@ class GameCategory(Base):
     """
     __tablename__ = 'game_categories'
     id = Column(Integer, primary_key=True)
-    name = Column(String(80), nullable=False)
+    name = Column(String(80), nullable=False, index=True, unique=True)
     games = relationship("Game",
                          secondary=games_categories_assoc,
                          back_populates="categories")
@@ -147,7 +208,7 @@ class ClubAdmin(Base):
         """
     __tablename__ = 'club_admins'
     id = Column(Integer, primary_key=True)
-    user_id = Column(Integer, ForeignKey('users.id'))
+    user_id = Column(Integer, ForeignKey('users.id'), index=True, unique=True)
 
 
 class Post(Base):
@@ -166,7 +227,7 @@ class Post(Base):
         """
     __tablename__ = 'posts'
     id = Column(Integer, primary_key=True)
-    user_id = Column(Integer, ForeignKey('users.id'))
+    user_id = Column(Integer, ForeignKey('users.id'), index=True)
     subject = Column(String(250), nullable=False)
     body = Column(String(1000), nullable=False)
     posted = Column(Integer, nullable=False)
@@ -0,0 +1,74 @@
+"""Opt-in request profiler and slow-query log.
+
+The profiler is enabled with the PROFILER setting. Requests sampled at
+PROFILER_SAMPLE_RATE, and requests of club admins sending the X-Profile
+header, are then run under cProfile and their profiles are dumped as
+.pstats files to PROFILER_DIR in the instance folder.
+
+SQL statements taking at least SLOW_QUERY_THRESHOLD seconds are logged
+with their parameters, duration and the endpoint of the request to
+SLOW_QUERY_LOG in the instance folder.
+"""
+
+import cProfile
+import itertools
+import logging
+import os
+import time
+from boardgameclub import app
+
+
+# Request header asking for the request to be profiled
+PROFILE_HEADER = 'X-Profile'
+
+
+def start_profiler():
+    """Return enabled profiler."""
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return profiler
+
+
+# Numbers of the profiles dumped by the process, so that profiles dumped
+# within the same second do not overwrite each other
+_profile_numbers = itertools.count(1)
+
+
+def dump_profile(profiler, endpoint):
+    """Stop the profiler and dump the profile to PROFILER_DIR.
+
+    Returns:
+        Path of the .pstats file.
+    """
+    profiler.disable()
+    directory = os.path.join(app.instance_path, app.config['PROFILER_DIR'])
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    path = os.path.join(directory, '{}-{}-{}-{}.pstats'.format(
+        endpoint or 'none', time.strftime('%Y%m%d-%H%M%S'), os.getpid(),
+        next(_profile_numbers)))
+    profiler.dump_stats(path)
+    return path
+
+
+slow_query_log = logging.getLogger('boardgameclub.slow_queries')
+slow_query_log.propagate = False
+if app.config['SLOW_QUERY_THRESHOLD'] is not None:
+    _handler = logging.FileHandler(os.path.join(app.instance_path,
+                                                app.config['SLOW_QUERY_LOG']))
+    _handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+    slow_query_log.addHandler(_handler)
+    slow_query_log.setLevel(logging.INFO)
+
+
+def log_slow_query(statement, parameters, duration, endpoint):
+    """Log SQL statement which took at least SLOW_QUERY_THRESHOLD.
+
+    Args:
+        statement (str): SQL statement.
+        parameters: its parameters.
+        duration (float): execution time in seconds.
+        endpoint (str): endpoint of the request or None outside requests.
+    """
+    slow_query_log.info('%.3fs %s %s %r', duration, endpoint or '-',
+                        ' '.join(statement.split()), parameters)
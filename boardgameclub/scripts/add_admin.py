@@ -5,6 +5,7 @@ To be run as a script.
 
 Part of the BoardGameClub app.
 """
+from boardgameclub.cache import bump_generation
 from boardgameclub.database import db_session
 from boardgameclub.models import User, ClubAdmin
 
@@ -19,6 +20,8 @@ def add_club_admin(user_email):
     else:
         admin = ClubAdmin(user_id=user.id)
         db_session.add(admin)
+        # Admin status is cached by the app and shown on the profile page
+        bump_generation('admins')
         db_session.commit()
         print 'User added to club admins'
 
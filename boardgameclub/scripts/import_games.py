@@ -0,0 +1,161 @@
+#!/usr/bin/env python2.7
+"""ImportGames program.
+
+To be run as a script.
+
+Imports many games from BGG into the collection of a user or the club.
+Game info is fetched in batches by several workers, subject to the rate
+limit of the BGG client, and all the games are added to the database in
+a single transaction.
+
+Part of the BoardGameClub app.
+"""
+import argparse
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+from boardgameclub.bgg import bgg_client, BGGError, RateLimiter
+from boardgameclub import similar
+from boardgameclub.cache import bump_generation
+from boardgameclub.database import db_session
+from boardgameclub.models import Club, Game, User
+from boardgameclub.views import resolve_categories
+
+
+def read_ids(ids, id_file):
+    """Return list of unique BGG ids given on the command line and/or
+    listed in a file (whitespace or comma separated).
+    """
+    if id_file:
+        with open(id_file, 'r') as f:
+            ids = ids + f.read().replace(',', ' ').split()
+    return list(OrderedDict.fromkeys(int(bgg_id) for bgg_id in ids))
+
+
+def get_target(user, club):
+    """Return User or Club whose collection is to be extended."""
+    if club:
+        return Club.query.filter_by(id=1).scalar()
+    if user.isdigit():
+        return User.query.filter_by(id=int(user)).scalar()
+    return User.query.filter_by(email=user).scalar()
+
+
+def chunks(items, size):
+    """Split list into consecutive chunks of the given size."""
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def fetch_games_info(bgg_ids, chunk_size, workers):
+    """Fetch info on games from BGG using a pool of worker threads.
+
+    Returns:
+        Dictionary mapping BGG id to dictionary with game info.
+    """
+    pool = ThreadPool(workers)
+    try:
+        results = pool.map(bgg_client.things, chunks(bgg_ids, chunk_size))
+    finally:
+        pool.close()
+    games_info = {}
+    for result in results:
+        games_info.update(result)
+    return games_info
+
+
+def import_games(bgg_ids, target, chunk_size=20, workers=4):
+    """Add games to the collection of the target in one transaction.
+
+    Games not yet in the database are created along with any missing
+    game categories.
+
+    Returns:
+        Number of games added to the collection.
+    """
+    # Games already in the database
+    games = {}
+    for chunk in chunks(bgg_ids, 500):
+        for game in Game.query.filter(Game.bgg_id.in_(chunk)):
+            games[game.bgg_id] = game
+    # Fetch info on the new games from BGG
+    new_ids = [bgg_id for bgg_id in bgg_ids if bgg_id not in games]
+    games_info = fetch_games_info(new_ids, chunk_size, workers)
+    for bgg_id in new_ids:
+        if bgg_id not in games_info:
+            print 'Game {} not found on BGG'.format(bgg_id)
+    # Resolve categories of the new games
+    names = set()
+    for game_info in games_info.values():
+        names.update(game_info['categories'])
+    categories = {}
+    for chunk in chunks(list(names), 500):
+        categories.update(resolve_categories(chunk))
+    # Add the new games to the database
+    new_games = []
+    for chunk in chunks(new_ids, chunk_size):
+        for bgg_id in chunk:
+            if bgg_id not in games_info:
+                continue
+            game_info = games_info[bgg_id]
+            game_categories = set(game_info.pop('categories'))
+            game = Game(**game_info)
+            game.categories = [categories[name] for name in game_categories]
+            db_session.add(game)
+            games[bgg_id] = game
+            new_games.append(game)
+        db_session.flush()
+    if new_games:
+        similar.update_games([game.id for game in new_games])
+    # Add the games to the collection
+    owned = set(game.id for game in target.games)
+    added = 0
+    for bgg_id in bgg_ids:
+        if bgg_id in games and games[bgg_id].id not in owned:
+            target.games.append(games[bgg_id])
+            owned.add(games[bgg_id].id)
+            added += 1
+    bump_generation()
+    db_session.commit()
+    return added
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Import games from BoardGameGeek into the collection of '
+                    'a user or the club.')
+    parser.add_argument('ids', nargs='*', help='BGG ids of the games')
+    parser.add_argument('-f', '--file', help='file with BGG ids')
+    target_group = parser.add_mutually_exclusive_group(required=True)
+    target_group.add_argument('-u', '--user', help="user's id or email")
+    target_group.add_argument('-c', '--club', action='store_true',
+                              help="import into the club's collection")
+    parser.add_argument('--chunk-size', type=int,
+                        default=bgg_client.batch_size,
+                        help='number of games fetched per BGG request')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='number of concurrent BGG requests')
+    parser.add_argument('--rate', type=float,
+                        help='maximum number of BGG requests per second')
+    args = parser.parse_args()
+
+    bgg_ids = read_ids(args.ids, args.file)
+    if not bgg_ids:
+        parser.error('no BGG ids given')
+    target = get_target(args.user, args.club)
+    if not target:
+        print 'User not found'
+        return
+    if args.rate is not None:
+        bgg_client.limiter = RateLimiter(args.rate)
+    bgg_client.batch_size = args.chunk_size
+    try:
+        added = import_games(bgg_ids, target, args.chunk_size, args.workers)
+    except BGGError as e:
+        db_session.rollback()
+        print e
+        print 'No games imported'
+        return
+    print '{} game(s) added to the collection'.format(added)
+
+
+if __name__ == '__main__':
+    main()
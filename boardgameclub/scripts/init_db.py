@@ -3,10 +3,27 @@
 
 To be run as a script.
 
+Creates a new database or upgrades an existing one to the current
+schema: missing tables, primary keys and indexes are added without loss
+of data. The similar-games index is built if empty.
+
+Duplicates preventing the creation of unique indexes are merged, or
+reported if they cannot be merged automatically, before the schema is
+changed. Schema changes are not atomic on SQLite, as pysqlite commits
+before every DDL statement; an interrupted upgrade is completed by
+running the program again.
+
 Part of the BoardGameClub app.
 """
-from boardgameclub.database import Base, engine, db_session
-from boardgameclub.models import Club
+import sys
+from sqlalchemy import select, func, and_, exists
+from boardgameclub.database import (Base, engine, db_session,
+                                    missing_schema_items)
+from boardgameclub.models import (Club, ClubAdmin, Game, GameCategory, User,
+                                  users_games_assoc, clubs_games_assoc,
+                                  games_categories_assoc, similar_games_assoc,
+                                  create_name_search)
+from boardgameclub import similar
 
 
 def init_club_info():
@@ -22,9 +39,130 @@ def init_db():
     Base.metadata.create_all(bind=engine)
 
 
+def find_duplicates(conn, column):
+    """Return list of (id, value) rows having the same value in a column
+    meant to be unique, ordered by id.
+    """
+    table = column.table
+    duplicated = select([column]).where(column.isnot(None)).group_by(
+        column).having(func.count() > 1)
+    return conn.execute(select([table.c.id, column])
+                        .where(column.in_(duplicated))
+                        .order_by(table.c.id)).fetchall()
+
+
+def redirect_reference(conn, reference, old_id, new_id):
+    """Point the rows of a link table at new_id instead of old_id,
+    dropping rows which would then duplicate an existing row.
+    """
+    table = reference.table
+    other = table.alias()
+    same_link = [other.c[reference.name] == new_id] + [
+        other.c[column.name] == column for column in table.primary_key.columns
+        if column is not reference]
+    conn.execute(table.delete().where(and_(
+        reference == old_id, exists().where(and_(*same_link)))))
+    conn.execute(table.update().where(reference == old_id)
+                 .values({reference.name: new_id}))
+
+
+def merge_duplicates(conn, column, references):
+    """Merge rows having the same value in a column meant to be unique.
+
+    The row with the lowest id is kept and references to the other rows
+    are redirected to it.
+
+    Args:
+        conn: database connection.
+        column: column of a table with an 'id' primary key.
+        references (list): columns of link tables referencing the table.
+    """
+    table = column.table
+    kept = {}
+    for row_id, value in find_duplicates(conn, column):
+        if value not in kept:
+            kept[value] = row_id
+            continue
+        for reference in references:
+            redirect_reference(conn, reference, row_id, kept[value])
+        conn.execute(table.delete().where(table.c.id == row_id))
+        print 'Merged duplicate {} {}'.format(table.name, value)
+
+
+def rebuild_table(conn, table):
+    """Recreate table with the defined primary key and indexes, keeping
+    its distinct rows.
+    """
+    old_name = table.name + '_old'
+    conn.execute('ALTER TABLE {} RENAME TO {}'.format(table.name, old_name))
+    table.create(bind=conn)
+    columns = ', '.join(table.columns.keys())
+    not_null = ' AND '.join('{} IS NOT NULL'.format(column)
+                            for column in table.primary_key.columns.keys())
+    conn.execute('INSERT INTO {} ({cols}) SELECT DISTINCT {cols} FROM {} '
+                 'WHERE {}'.format(table.name, old_name, not_null,
+                                   cols=columns))
+    conn.execute('DROP TABLE {}'.format(old_name))
+    print 'Added primary key to {}'.format(table.name)
+
+
+def upgrade_db():
+    """Add primary keys, indexes and full-text search missing from an
+    existing database.
+
+    Unique indexes cannot be created over duplicates, so these are
+    dealt with first, in one transaction: duplicate games, game
+    categories and club admins are merged. Users with the same email
+    are separate accounts which are not merged automatically; they are
+    reported and the upgrade is aborted before any change is made.
+    """
+    missing_pks, missing_indexes, missing_search = missing_schema_items()
+    if not missing_pks and not missing_indexes and not missing_search:
+        return
+    with engine.begin() as conn:
+        users = find_duplicates(conn, User.__table__.c.email)
+        if users:
+            for user_id, email in users:
+                print 'Duplicate user {} {}'.format(user_id, email)
+            sys.exit('Merge or remove the users sharing an email and run '
+                     'the upgrade again')
+        merge_duplicates(conn, Game.__table__.c.bgg_id, [
+            users_games_assoc.c.game_id, clubs_games_assoc.c.game_id,
+            games_categories_assoc.c.game_id])
+        merge_duplicates(conn, GameCategory.__table__.c.name, [
+            games_categories_assoc.c.category_id])
+        merge_duplicates(conn, ClubAdmin.__table__.c.user_id, [])
+    # pysqlite commits before each DDL statement, so the following
+    # changes are not atomic on SQLite
+    with engine.begin() as conn:
+        for table in missing_pks:
+            rebuild_table(conn, table)
+        for index in missing_indexes:
+            if index.table not in missing_pks:
+                index.create(bind=conn)
+                print 'Added index {}'.format(index.name)
+        if missing_search:
+            create_name_search(Game.__table__, conn)
+            print 'Added full-text search on game names'
+
+
+def build_similar_games():
+    """Build the similar-games index unless already built."""
+    if (db_session.query(similar_games_assoc).first() is None and
+            db_session.query(Game.id).first() is not None):
+        count = similar.rebuild()
+        db_session.commit()
+        print 'Found similar games of {} games'.format(count)
+
+
 def main():
+    # Existing tables are upgraded before the missing ones are created,
+    # so that nothing is changed if the upgrade is aborted
+    upgrade_db()
     init_db()
-    init_club_info()
+    build_similar_games()
+    if not Club.query.filter_by(id=1).scalar():
+        init_club_info()
     print 'Database initialized'
 
 
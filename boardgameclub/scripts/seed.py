@@ -0,0 +1,301 @@
+#!/usr/bin/env python2.7
+"""Seed program.
+
+To be run as a script.
+
+Fills the database with synthetic users, games, game categories,
+collections and posts for scale testing. Game attributes follow
+realistic distributions and ownership of games follows the Zipf
+distribution: a few games are owned by many users and most games by
+few, but every game by at least one user or the club, so that no game
+is an orphan to be removed by bgc_sweep. Rows are added with bulk
+inserts in a single transaction and the data is the same for the same
+seed.
+
+Part of the BoardGameClub app.
+"""
+import argparse
+import bisect
+import random
+import time
+from sqlalchemy import select, func
+from boardgameclub import similar
+from boardgameclub.cache import bump_generation
+from boardgameclub.database import db_session
+from boardgameclub.models import (Club, Game, GameCategory, Post, User,
+                                  users_games_assoc, clubs_games_assoc,
+                                  games_categories_assoc)
+
+
+CATEGORY_NAMES = [
+    'Abstract Strategy', 'Adventure', 'Animals', 'Bluffing', 'Card Game',
+    'City Building', 'Civilization', 'Deduction', 'Dice', 'Economic',
+    'Exploration', 'Fantasy', 'Farming', 'Fighting', 'Horror', 'Humor',
+    'Medieval', 'Miniatures', 'Mythology', 'Nautical', 'Negotiation',
+    'Party Game', 'Political', 'Puzzle', 'Racing', 'Science Fiction',
+    'Space Exploration', 'Territory Building', 'Trains', 'Wargame']
+
+NAME_WORDS = [
+    ('Ancient', 'Crimson', 'Lost', 'Golden', 'Hidden', 'Iron', 'Northern',
+     'Silent', 'Twilight', 'Wild', 'Royal', 'Stellar', 'Sunken', 'Frozen'),
+    ('Empire', 'Harbor', 'Kingdom', 'Valley', 'Legacy', 'Frontier', 'Castle',
+     'Voyage', 'Dungeon', 'Railways', 'Orchard', 'Colony', 'Bazaar', 'Oracle')]
+
+# Posts are dated within three years before this time (2020-01-01 UTC) so
+# that the data does not depend on when it was seeded
+POSTS_UNTIL = 1577836800
+POSTS_PERIOD = 3 * 365 * 24 * 3600
+
+LOREM = ('lorem ipsum dolor sit amet consectetur adipiscing elit sed do '
+         'eiusmod tempor incididunt ut labore et dolore magna aliqua').split()
+
+
+class ZipfSampler(object):
+    """Draws ranks from 0 to n - 1 with probability proportional to
+    1 / (rank + 1) ** exponent.
+
+    Args:
+        n (int): number of ranks.
+        exponent (float): exponent of the distribution.
+        rng (random.Random): source of randomness.
+    """
+
+    def __init__(self, n, exponent, rng):
+        self.rng = rng
+        self.cumulative = []
+        total = 0.0
+        for rank in xrange(n):
+            total += 1.0 / (rank + 1) ** exponent
+            self.cumulative.append(total)
+        self.total = total
+
+    def sample(self):
+        """Return a random rank."""
+        return bisect.bisect_left(self.cumulative,
+                                  self.rng.random() * self.total)
+
+    def sample_distinct(self, k):
+        """Return set of up to k distinct random ranks."""
+        ranks = set()
+        attempts = 0
+        while len(ranks) < k and attempts < 20 * k:
+            ranks.add(self.sample())
+            attempts += 1
+        return ranks
+
+
+def next_id(column):
+    """Return first id following the ids already in the table."""
+    return (db_session.query(func.max(column)).scalar() or 0) + 1
+
+
+def bulk_insert(table, rows, batch_size):
+    """Insert rows in batches of up to batch_size rows, each batch with
+    a single executemany call.
+    """
+    for i in range(0, len(rows), batch_size):
+        db_session.execute(table.insert(), rows[i:i + batch_size])
+
+
+def make_categories(count):
+    """Return names of count game categories."""
+    names = CATEGORY_NAMES[:count]
+    names.extend('Category {}'.format(i)
+                 for i in range(len(names) + 1, count + 1))
+    return names
+
+
+def make_game(rng, game_id, bgg_id):
+    """Return row of a game with random attributes."""
+    weight = 1 + 4 * rng.betavariate(2, 3.5)
+    # Heavier games are rated somewhat higher
+    rating = min(max(rng.gauss(5.8 + 0.4 * weight, 0.8), 1), 10)
+    min_players = rng.choice([1, 1, 2, 2, 2, 2, 2, 3, 3, 4])
+    max_players = min_players + rng.choice([0, 1, 2, 2, 3, 3, 4, 6])
+    max_playtime = max(5, int(round(rng.lognormvariate(3.6, 0.7) / 5)) * 5)
+    min_playtime = max(5, int(max_playtime * rng.choice([0.5, 0.75, 1])))
+    name = '{} {}'.format(rng.choice(NAME_WORDS[0]), rng.choice(NAME_WORDS[1]))
+    if rng.random() < 0.7:
+        name = '{} {}'.format(name, game_id)
+    return {
+        'id': game_id,
+        'name': name,
+        'year_published': int(2020 - rng.expovariate(1 / 12.0)),
+        'image': 'https://example.com/images/{}.jpg'.format(bgg_id),
+        'min_age': rng.choice([6, 8, 10, 12, 12, 14]),
+        'weight': round(weight, 3),
+        'min_playtime': min_playtime,
+        'max_playtime': max_playtime,
+        'min_players': min_players,
+        'max_players': max_players,
+        'bgg_rating': round(rating, 3),
+        'bgg_id': bgg_id,
+        'bgg_link': 'https://boardgamegeek.com/boardgame/{}'.format(bgg_id)
+    }
+
+
+def seed(rng, users, games, categories, owned, club_games, posts, exponent,
+         batch_size):
+    """Add synthetic data to the database in one transaction.
+
+    Args:
+        rng (random.Random): source of randomness.
+        users (int): number of users.
+        games (int): number of games.
+        categories (int): number of game categories; existing categories
+            with the same names are reused.
+        owned (int): mean number of games owned by a user.
+        club_games (int): number of games added to the club's collection.
+        posts (int): number of posts.
+        exponent (float): exponent of the Zipf distribution of ownership.
+        batch_size (int): rows per insert batch.
+
+    Returns:
+        Dictionary mapping table name to number of rows added.
+    """
+    counts = {}
+    # Game categories
+    names = make_categories(categories)
+    existing = dict(db_session.query(GameCategory.name, GameCategory.id)
+                    .filter(GameCategory.name.in_(names)))
+    category_id = next_id(GameCategory.id)
+    category_rows = []
+    for name in names:
+        if name not in existing:
+            existing[name] = category_id
+            category_rows.append({'id': category_id, 'name': name})
+            category_id += 1
+    bulk_insert(GameCategory.__table__, category_rows, batch_size)
+    counts['game_categories'] = len(category_rows)
+    category_ids = [existing[name] for name in names]
+    # Games, with the most popular categories first
+    first_game = next_id(Game.id)
+    first_bgg = max(next_id(Game.bgg_id), 10 ** 7)
+    game_ids = range(first_game, first_game + games)
+    bulk_insert(Game.__table__,
+                [make_game(rng, game_id, first_bgg + i)
+                 for i, game_id in enumerate(game_ids)], batch_size)
+    counts['games'] = games
+    category_sampler = ZipfSampler(len(category_ids), 1.0, rng)
+    category_rows = []
+    for game_id in game_ids:
+        for rank in sorted(category_sampler.sample_distinct(
+                rng.choice([1, 1, 2, 2, 3, 4]))):
+            category_rows.append({'game_id': game_id,
+                                  'category_id': category_ids[rank]})
+    bulk_insert(games_categories_assoc, category_rows, batch_size)
+    counts['games_categories'] = len(category_rows)
+    # Users
+    first_user = next_id(User.id)
+    user_ids = range(first_user, first_user + users)
+    bulk_insert(User.__table__, [
+        {'id': user_id,
+         'email': 'seed-user-{}@example.com'.format(user_id),
+         'name': 'Seed User {}'.format(user_id),
+         'picture': 'https://example.com/avatars/{}.png'.format(user_id)}
+        for user_id in user_ids], batch_size)
+    counts['users'] = users
+    # Collections; popularity of games follows the Zipf distribution
+    popularity = list(game_ids)
+    rng.shuffle(popularity)
+    game_sampler = ZipfSampler(len(popularity), exponent, rng)
+    ownership_rows = []
+    for user_id in user_ids:
+        count = min(int(rng.expovariate(1.0 / owned)) if owned else 0,
+                    len(popularity) // 2)
+        for rank in sorted(game_sampler.sample_distinct(count)):
+            ownership_rows.append({'user_id': user_id,
+                                   'game_id': popularity[rank]})
+    bulk_insert(users_games_assoc, ownership_rows, batch_size)
+    counts['users_games'] = len(ownership_rows)
+    club = db_session.query(Club.id).filter_by(id=1).scalar()
+    club_rows = []
+    if club:
+        owned_by_club = set(game_id for (game_id,) in db_session.execute(
+            select([clubs_games_assoc.c.game_id]).where(
+                clubs_games_assoc.c.club_id == club)))
+        for rank in sorted(game_sampler.sample_distinct(
+                min(club_games, len(popularity) // 2))):
+            if popularity[rank] not in owned_by_club:
+                club_rows.append({'club_id': club,
+                                  'game_id': popularity[rank]})
+    # Games nobody owns are orphans removed by bgc_sweep, so each of them
+    # is given to a user, the most active users getting most of them, or
+    # to the club if there are no users
+    owned_games = set(row['game_id'] for row in ownership_rows + club_rows)
+    unowned = [game_id for game_id in game_ids if game_id not in owned_games]
+    if user_ids:
+        owner_sampler = ZipfSampler(len(user_ids), 1.0, rng)
+        extra_rows = [{'user_id': user_ids[owner_sampler.sample()],
+                       'game_id': game_id} for game_id in unowned]
+        bulk_insert(users_games_assoc, extra_rows, batch_size)
+        counts['users_games'] += len(extra_rows)
+    elif club:
+        club_rows.extend({'club_id': club, 'game_id': game_id}
+                         for game_id in unowned)
+    if club:
+        bulk_insert(clubs_games_assoc, club_rows, batch_size)
+    counts['clubs_games'] = len(club_rows)
+    # Posts, with the most active users writing most of them
+    if user_ids:
+        author_sampler = ZipfSampler(len(user_ids), 1.0, rng)
+        post_rows = []
+        for posted in sorted(rng.randint(POSTS_UNTIL - POSTS_PERIOD,
+                                         POSTS_UNTIL) for i in xrange(posts)):
+            body = ' '.join(rng.choice(LOREM)
+                            for i in xrange(rng.randint(10, 120)))[:998]
+            post_rows.append({
+                'user_id': user_ids[author_sampler.sample()],
+                'subject': ' '.join(rng.choice(LOREM)
+                                    for i in xrange(rng.randint(2, 6))),
+                'body': body.capitalize() + '.',
+                'posted': posted,
+                'edited': posted + 600 if rng.random() < 0.1 else None})
+        bulk_insert(Post.__table__, post_rows, batch_size)
+        counts['posts'] = len(post_rows)
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Fill the database with synthetic data for scale '
+                    'testing.')
+    parser.add_argument('--users', type=int, default=2000,
+                        help='number of users')
+    parser.add_argument('--games', type=int, default=100000,
+                        help='number of games')
+    parser.add_argument('--categories', type=int, default=80,
+                        help='number of game categories')
+    parser.add_argument('--owned', type=int, default=50,
+                        help='mean number of games owned by a user')
+    parser.add_argument('--club-games', type=int, default=500,
+                        help="number of games in the club's collection")
+    parser.add_argument('--posts', type=int, default=10000,
+                        help='number of posts')
+    parser.add_argument('--zipf', type=float, default=1.1,
+                        help='exponent of the Zipf distribution of ownership')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed of the random number generator')
+    parser.add_argument('--batch-size', type=int, default=5000,
+                        help='rows per insert batch')
+    parser.add_argument('--similar', action='store_true',
+                        help='rebuild the similar-games index afterwards; '
+                             'slow for many games')
+    args = parser.parse_args()
+
+    start = time.time()
+    counts = seed(random.Random(args.seed), args.users, args.games,
+                  args.categories, args.owned, args.club_games, args.posts,
+                  args.zipf, args.batch_size)
+    if args.similar:
+        similar.rebuild()
+    bump_generation()
+    bump_generation('posts')
+    db_session.commit()
+    for table in sorted(counts):
+        print '{}: {} row(s) added'.format(table, counts[table])
+    print 'Done in {:.1f}s'.format(time.time() - start)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,21 @@
+#!/usr/bin/env python2.7
+"""Sweep program.
+
+To be run as a script.
+
+Removes games not owned by any user or the club and game categories
+without any games from the database. Meant to be run periodically when
+DEFER_ORPHAN_SWEEP is set.
+
+Part of the BoardGameClub app.
+"""
+from boardgameclub.views import clear_games
+
+
+def main():
+    removed = clear_games()
+    print '{} orphaned game(s) removed'.format(removed)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,387 @@
+"""Similar-games index.
+
+For each game the similar_games table holds up to SIMILAR_GAMES games
+most similar to it. Similarity combines the overlap of game categories
+(Jaccard index) with closeness in complexity and in the supported
+numbers of players. A game is compared only with its candidates: in
+each of its categories, the SIMILAR_CANDIDATES / 2 games preceding it
+and as many following it in the order of complexity. The work per game
+therefore does not grow with the size of the categories.
+
+The table is updated incrementally as games are added, updated and
+removed, loading only the changed games, their candidates and the rows
+referring to them, and rebuilt from scratch by bgc_init_db if empty.
+Incremental updates approximate a rebuild: a changed game is offered
+to the lists of its own candidates only, and lists losing a game are
+refilled from the lists of that game and of the games left in them.
+"""
+
+import heapq
+import sqlalchemy
+from boardgameclub import app
+from boardgameclub.database import db_session
+from boardgameclub.models import (Game, games_categories_assoc,
+                                  similar_games_assoc)
+
+
+# Weights of the components of the similarity score
+CATEGORIES_WEIGHT = 0.6
+COMPLEXITY_WEIGHT = 0.2
+PLAYERS_WEIGHT = 0.2
+
+# Maximum number of ids in an IN clause
+CHUNK_SIZE = 500
+
+
+def chunks(ids):
+    """Split the ids into lists of up to CHUNK_SIZE ids."""
+    ids = list(ids)
+    return [ids[i:i + CHUNK_SIZE] for i in range(0, len(ids), CHUNK_SIZE)]
+
+
+def complexity_key(weight):
+    """Return the position of a game in the order of complexity; games
+    without complexity come first.
+    """
+    return -1.0 if weight is None else float(weight)
+
+
+# complexity_key in SQL
+_complexity = sqlalchemy.func.coalesce(
+    sqlalchemy.type_coerce(Game.__table__.c.weight, sqlalchemy.Float), -1)
+
+
+class Features(object):
+    """Attributes of the games compared by similarity.
+
+    Only the games given to load are held.
+
+    Attributes:
+        games (dict): game id to (weight, min_players, max_players).
+        keys (dict): game id to complexity_key of the game.
+        categories (dict): game id to set of its category ids.
+    """
+
+    def __init__(self):
+        self.games = {}
+        self.keys = {}
+        self.categories = {}
+
+    def _add(self, rows):
+        for row in rows:
+            weight = float(row.weight) if row.weight else None
+            self.games[row.id] = (weight, row.min_players, row.max_players)
+            self.keys[row.id] = complexity_key(row.weight)
+            self.categories[row.id] = set()
+
+    def _add_categories(self, rows):
+        for game_id, category_id in rows:
+            if game_id in self.categories:
+                self.categories[game_id].add(category_id)
+
+    def load(self, game_ids=None):
+        """Load the games not loaded yet.
+
+        Args:
+            game_ids (iterable): ids of the games or None for all the
+                games in the database.
+        """
+        games = Game.__table__
+        links = games_categories_assoc
+        select_games = sqlalchemy.select(
+            [games.c.id, games.c.weight, games.c.min_players,
+             games.c.max_players])
+        select_links = sqlalchemy.select(
+            [links.c.game_id, links.c.category_id])
+        if game_ids is None:
+            self._add(db_session.execute(select_games))
+            self._add_categories(db_session.execute(select_links))
+            return
+        for chunk in chunks(set(game_ids).difference(self.games)):
+            self._add(db_session.execute(
+                select_games.where(games.c.id.in_(chunk))))
+            self._add_categories(db_session.execute(
+                select_links.where(links.c.game_id.in_(chunk))))
+
+    def score(self, game_id, other_id):
+        """Return similarity score of two games, from 0 to 1."""
+        categories = self.categories[game_id]
+        other_categories = self.categories[other_id]
+        score = CATEGORIES_WEIGHT * (
+            float(len(categories & other_categories)) /
+            len(categories | other_categories))
+        weight, min_players, max_players = self.games[game_id]
+        other_weight, other_min, other_max = self.games[other_id]
+        if weight and other_weight:
+            # Complexity ranges from 1 to 5
+            score += COMPLEXITY_WEIGHT * (
+                1 - min(abs(weight - other_weight), 4) / 4.0)
+        if None not in (min_players, max_players, other_min, other_max):
+            common = min(max_players, other_max) - max(min_players,
+                                                       other_min) + 1
+            if common > 0:
+                score += PLAYERS_WEIGHT * float(common) / (
+                    max(max_players, other_max) -
+                    min(min_players, other_min) + 1)
+        return score
+
+    def most_similar(self, game_id, candidates, k):
+        """Return list of (score, id) of the k candidates most similar to
+        the game, best first; ties are broken by lower id.
+        """
+        scores = [(self.score(game_id, other_id), other_id)
+                  for other_id in candidates]
+        return heapq.nlargest(k, scores, key=_rank)
+
+
+def _rank(neighbour):
+    """Sort key of (score, id) neighbours; higher is better."""
+    return neighbour[0], -neighbour[1]
+
+
+def category_window(category_id, game_id, key, size):
+    """Return ids of up to size games of the category preceding the game
+    and as many following it in the order of complexity.
+
+    Args:
+        category_id (int): id of the category.
+        game_id (int): id of the game.
+        key (float): complexity_key of the game.
+        size (int): number of games on each side.
+    """
+    games = Game.__table__
+    links = games_categories_assoc
+    members = sqlalchemy.select([games.c.id]).select_from(
+        games.join(links, links.c.game_id == games.c.id)).where(
+        links.c.category_id == category_id)
+    below = members.where(sqlalchemy.or_(
+        _complexity < key,
+        sqlalchemy.and_(_complexity == key, games.c.id < game_id))).order_by(
+        _complexity.desc(), games.c.id.desc()).limit(size)
+    above = members.where(sqlalchemy.or_(
+        _complexity > key,
+        sqlalchemy.and_(_complexity == key, games.c.id > game_id))).order_by(
+        _complexity, games.c.id).limit(size)
+    return [row.id for row in db_session.execute(sqlalchemy.union_all(
+        below.alias().select(), above.alias().select()))]
+
+
+def load_neighbours(game_ids):
+    """Return dictionary mapping id of each of the games to list of
+    (score, id) of its most similar games as held in the database, best
+    first.
+    """
+    neighbours = dict((game_id, []) for game_id in game_ids)
+    for chunk in chunks(neighbours):
+        for game_id, similar_id, score in db_session.execute(
+                sqlalchemy.select([similar_games_assoc.c.game_id,
+                                   similar_games_assoc.c.similar_id,
+                                   similar_games_assoc.c.score]).where(
+                    similar_games_assoc.c.game_id.in_(chunk))):
+            neighbours[game_id].append((score, similar_id))
+    for similar in neighbours.itervalues():
+        similar.sort(key=_rank, reverse=True)
+    return neighbours
+
+
+def referring_games(game_ids):
+    """Return ids of the games whose lists refer to the games."""
+    referring = set()
+    for chunk in chunks(game_ids):
+        referring.update(row.game_id for row in db_session.execute(
+            sqlalchemy.select([similar_games_assoc.c.game_id]).where(
+                similar_games_assoc.c.similar_id.in_(chunk))))
+    return referring
+
+
+def insert_neighbours(neighbours, game_ids):
+    """Insert rows of the games into the similar_games table."""
+    rows = [{'game_id': game_id, 'similar_id': similar_id, 'score': score}
+            for game_id in game_ids
+            for score, similar_id in neighbours.get(game_id, [])]
+    if rows:
+        db_session.execute(similar_games_assoc.insert(), rows)
+
+
+def save_neighbours(neighbours, game_ids):
+    """Replace the rows of the games in the similar_games table."""
+    for chunk in chunks(game_ids):
+        db_session.execute(similar_games_assoc.delete().where(
+            similar_games_assoc.c.game_id.in_(chunk)))
+    insert_neighbours(neighbours, game_ids)
+
+
+def offer(similar, candidate, k):
+    """Put the (score, id) candidate in its place in the list, replacing
+    its previous entry, if it is among the k best.
+
+    Returns:
+        bool: True if the list has changed.
+    """
+    kept = [neighbour for neighbour in similar if neighbour[1] != candidate[1]]
+    changed = len(kept) != len(similar)
+    if len(kept) < k or _rank(candidate) > _rank(kept[-1]):
+        kept.append(candidate)
+        kept.sort(key=_rank, reverse=True)
+        del kept[k:]
+        changed = True
+    similar[:] = kept
+    return changed
+
+
+def refill(neighbours, lost, lists, features, k, exclude):
+    """Fill up the lists of the games which have lost some of their
+    games.
+
+    Each game is compared with the games listed by the games left in its
+    list and by the games it has lost, which are likely similar to it as
+    well; only games sharing a category with it qualify.
+
+    Args:
+        neighbours (dict): lists of the games, see load_neighbours.
+        lost (dict): id of each of the games to set of ids of the games
+            it has lost.
+        lists (dict): lists of the lost games.
+        features (Features): features of the games.
+        k (int): length of the lists.
+        exclude (set): ids of games not to be listed.
+    """
+    second = load_neighbours(set(
+        similar_id for game_id in lost
+        for score, similar_id in neighbours[game_id]))
+    pools = {}
+    for game_id, lost_ids in lost.iteritems():
+        pool = set(similar_id for score, similar_id in neighbours[game_id])
+        for other_id in pool.copy():
+            pool.update(similar_id for score, similar_id in second[other_id])
+        for lost_id in lost_ids:
+            pool.update(similar_id
+                        for score, similar_id in lists.get(lost_id, ()))
+        pool.discard(game_id)
+        pools[game_id] = pool - exclude
+    features.load(set().union(*pools.values()) if pools else ())
+    for game_id, pool in pools.iteritems():
+        categories = features.categories[game_id]
+        neighbours[game_id] = features.most_similar(
+            game_id, [other_id for other_id in pool if other_id in
+                      features.games and categories & features.categories[
+                          other_id]], k)
+
+
+def strand(neighbours, game_ids, stale):
+    """Remove the stale games from the lists of the games.
+
+    Returns:
+        dict: id of each of the games to set of ids of the games removed
+        from its list.
+    """
+    lost = {}
+    for game_id in game_ids:
+        lost[game_id] = set(similar_id
+                            for score, similar_id in neighbours[game_id]
+                            if similar_id in stale)
+        neighbours[game_id] = [neighbour for neighbour in neighbours[game_id]
+                               if neighbour[1] not in stale]
+    return lost
+
+
+def update_games(game_ids, removed=False):
+    """Update the index after the games have been added, updated or
+    are about to be removed. Changes are not committed.
+
+    The lists of the given games are recomputed from their candidates,
+    and the games are offered to the lists of their candidates. Lists
+    referring to the games which are no longer their candidates lose
+    them and are refilled, see refill.
+
+    Args:
+        game_ids (list): ids of the games.
+        removed (bool): True if the games are about to be removed from
+            the database; their rows and all rows referring to them are
+            deleted.
+    """
+    stale = set(game_ids)
+    k = app.config['SIMILAR_GAMES']
+    size = app.config['SIMILAR_CANDIDATES'] // 2
+    referring = referring_games(stale) - stale
+    features = Features()
+    if removed:
+        lists = load_neighbours(stale)
+        neighbours = load_neighbours(referring)
+        # Rows referring to removed games must go before the games do
+        for column in (similar_games_assoc.c.game_id,
+                       similar_games_assoc.c.similar_id):
+            for chunk in chunks(stale):
+                db_session.execute(similar_games_assoc.delete().where(
+                    column.in_(chunk)))
+        features.load(referring)
+        refill(neighbours, strand(neighbours, referring, stale), lists,
+               features, k, stale)
+        save_neighbours(neighbours, referring)
+        return
+    features.load(stale)
+    present = [game_id for game_id in stale if game_id in features.games]
+    candidates = {}
+    for game_id in present:
+        candidates[game_id] = set()
+        for category_id in features.categories[game_id]:
+            candidates[game_id].update(category_window(
+                category_id, game_id, features.keys[game_id], size))
+    offered = set().union(*candidates.values()) if candidates else set()
+    features.load(offered | referring)
+    neighbours = load_neighbours((offered | referring) - stale)
+    changed = set(present)
+    for game_id in present:
+        neighbours[game_id] = features.most_similar(
+            game_id, candidates[game_id], k)
+    # Offer the given games to the lists of their candidates
+    for game_id in present:
+        for other_id in candidates[game_id]:
+            if other_id not in stale and offer(
+                    neighbours[other_id],
+                    (features.score(other_id, game_id), game_id), k):
+                changed.add(other_id)
+    # Lists referring to the games which are no longer their candidates
+    stranded = referring - offered
+    refill(neighbours, strand(neighbours, stranded, stale), neighbours,
+           features, k, stale)
+    save_neighbours(neighbours, changed | stranded)
+
+
+def rebuild():
+    """Recompute the whole index. Changes are not committed.
+
+    Returns:
+        int: number of games in the index.
+    """
+    features = Features()
+    features.load()
+    k = app.config['SIMILAR_GAMES']
+    size = app.config['SIMILAR_CANDIDATES'] // 2
+    # Members of each category in the order of complexity
+    members = {}
+    for game_id, categories in features.categories.iteritems():
+        for category_id in categories:
+            members.setdefault(category_id, []).append(
+                (features.keys[game_id], game_id))
+    positions = {}
+    for category_id, ordered in members.iteritems():
+        ordered.sort()
+        members[category_id] = [game_id for key, game_id in ordered]
+        for i, game_id in enumerate(members[category_id]):
+            positions[category_id, game_id] = i
+    db_session.execute(similar_games_assoc.delete())
+    neighbours = {}
+    for game_id in features.games:
+        candidates = set()
+        for category_id in features.categories[game_id]:
+            ordered = members[category_id]
+            i = positions[category_id, game_id]
+            candidates.update(ordered[max(0, i - size):i])
+            candidates.update(ordered[i + 1:i + 1 + size])
+        neighbours[game_id] = features.most_similar(game_id, candidates, k)
+        if len(neighbours) == CHUNK_SIZE:
+            insert_neighbours(neighbours, neighbours.keys())
+            neighbours = {}
+    insert_neighbours(neighbours, neighbours.keys())
+    return len(features.games)
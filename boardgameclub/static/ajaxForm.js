@@ -25,7 +25,7 @@ function ajaxDelete(formD){
 	  },
 		processData: false,
 	  data: JSON.stringify({
-			"_csrf_token": $(formD).children('input[name="_csrf_token"]').val()
+			"_csrf_token": csrfToken(formD)
 		})
 	});
 }
@@ -51,7 +51,7 @@ function makePayload(formP){
 //Make payload for patch requests
 	var attr = $(formP).children('textarea, input[type="text"]').serializeArray();
 	var payload = {
-		"_csrf_token": $(formP).children('input[name="_csrf_token"]').val(),
+		"_csrf_token": csrfToken(formP),
 	  "data": {
 		"type": $(formP).children('input[name="type"]').val(),
 		"id": $(formP).children('input[name="id"]').val(),
@@ -61,6 +61,12 @@ function makePayload(formP){
 	return JSON.stringify(payload);
 }
 
+function csrfToken(form){
+//Return csrf token of the form or, for forms in cached fragments, of the page
+	return $(form).children('input[name="_csrf_token"]').val() ||
+		$('meta[name="_csrf_token"]').attr('content');
+}
+
 function updateToggle(editButton){
 //Toggle view for patch/delete forms
 	$(editButton).siblings('.update-hide, .ajax-form').toggleClass('hidden')
@@ -1,20 +1,147 @@
-from flask import (render_template, url_for, request, redirect, session, abort,
-                   make_response, jsonify, flash)
+import functools
+import flask
+from flask import (url_for, request, redirect, session, abort, make_response,
+                   jsonify, flash, Response, stream_with_context, g,
+                   has_request_context)
 import sqlalchemy
 import sqlalchemy.orm.exc
 import requests
-from xml.etree import ElementTree
 import json
+import base64
+import hmac
 import time
 import string
 import random
 from decimal import Decimal
 from oauth2client import client
+try:
+    import ujson
+except ImportError:
+    ujson = None
 from boardgameclub import app
-from boardgameclub.database import db_session
+from boardgameclub.bgg import bgg_client, BGGError
+from boardgameclub.lru import LRUCache
+from boardgameclub import filters, similar, metrics, profiling
+from boardgameclub.cache import (cached, conditional, bump_generation,
+                                 current_generations)
+from boardgameclub.fragments import FragmentCacheExtension
+from boardgameclub.google_auth import google_keys, verify_id_token, TokenError
+from boardgameclub.game_index import game_index
+from boardgameclub.database import (db_session, engine, insert_ignore,
+                                    missing_schema_items)
 from boardgameclub.models import (Club, Game, Post,  User, GameCategory,
                                   ClubAdmin, clubs_games_assoc,
-                                  users_games_assoc)
+                                  users_games_assoc, games_categories_assoc,
+                                  similar_games_assoc)
+
+
+# Game columns displayed in games-table.html
+GAMES_TABLE_COLUMNS = (Game.id, Game.name, Game.bgg_rating, Game.min_players,
+                       Game.max_players, Game.min_playtime, Game.max_playtime,
+                       Game.weight)
+
+# Columns returned by the Info API endpoint, by type
+INFO_COLUMNS = {
+    'users': (User.__table__.c.id, User.__table__.c.name),
+    'categories': (GameCategory.__table__.c.id, GameCategory.__table__.c.name),
+    'games': (Game.__table__.c.id, Game.__table__.c.name,
+              Game.__table__.c.year_published)
+}
+
+
+###################
+# Instrumentation #
+###################
+
+# Registered first, so that the work of all the other hooks counts
+
+@app.before_request
+def start_request_metrics():
+    """Start measuring the request."""
+    g.request_start = time.time()
+    g.query_count = 0
+    g.query_time = 0.0
+    g.render_time = 0.0
+    g.bgg_count = 0
+    g.bgg_time = 0.0
+
+
+@sqlalchemy.event.listens_for(engine, 'before_cursor_execute')
+def start_query(conn, cursor, statement, parameters, context, executemany):
+    """Note start time of SQL statement."""
+    conn.info.setdefault('query_start', []).append(time.time())
+
+
+@sqlalchemy.event.listens_for(engine, 'after_cursor_execute')
+def end_query(conn, cursor, statement, parameters, context, executemany):
+    """Add SQL statement to the metrics of the current request."""
+    elapsed = time.time() - conn.info['query_start'].pop()
+    in_request = has_request_context()
+    if in_request and 'query_count' in g:
+        g.query_count += 1
+        g.query_time += elapsed
+    threshold = app.config['SLOW_QUERY_THRESHOLD']
+    if threshold is not None and elapsed >= threshold:
+        profiling.log_slow_query(statement, parameters, elapsed,
+                                 request.endpoint if in_request else None)
+
+
+@app.before_request
+def start_profiler():
+    """Profile the request if sampled or asked for by a club admin."""
+    if not app.config['PROFILER']:
+        return
+    user_id = session.get('user_id')
+    if (
+        random.random() < app.config['PROFILER_SAMPLE_RATE'] or
+        profiling.PROFILE_HEADER in request.headers and
+        user_id and is_admin(user_id)
+    ):
+        g.profiler = profiling.start_profiler()
+
+
+@app.teardown_request
+def stop_profiler(exception=None):
+    """Dump profile of the request if profiled."""
+    if 'profiler' in g:
+        path = profiling.dump_profile(g.pop('profiler'), request.endpoint)
+        app.logger.info('Profile of %s saved to %s', request.path, path)
+
+
+def render_template(template_name, **context):
+    """Render the template with flask.render_template and add the render
+    time to the metrics of the current request.
+    """
+    start = time.time()
+    try:
+        return flask.render_template(template_name, **context)
+    finally:
+        g.render_time = g.get('render_time', 0.0) + time.time() - start
+
+
+@app.teardown_request
+def record_request_metrics(exception=None):
+    """Record metrics of the request and warn if it executed more SQL
+    statements than allowed by the QUERY_BUDGETS setting of its endpoint
+    or else by the QUERY_BUDGET setting.
+    """
+    if 'request_start' not in g:
+        return
+    endpoint = request.endpoint or 'none'
+    metrics.request_seconds.observe(time.time() - g.request_start, endpoint)
+    metrics.sql_statements.observe(g.query_count, endpoint)
+    metrics.sql_seconds.observe(g.query_time, endpoint)
+    if g.render_time:
+        metrics.render_seconds.observe(g.render_time, endpoint)
+    metrics.bgg_requests.observe(g.bgg_count, endpoint)
+    if g.bgg_count:
+        metrics.bgg_seconds.observe(g.bgg_time, endpoint)
+    budget = app.config['QUERY_BUDGETS'].get(endpoint,
+                                             app.config['QUERY_BUDGET'])
+    if budget is not None and g.query_count > budget:
+        app.logger.warning('%s %s executed %d SQL statements, over the '
+                           'budget of %d', request.method, request.path,
+                           g.query_count, budget)
 
 
 ###################
@@ -29,7 +156,7 @@ from boardgameclub.models import (Club, Game, Post,  User, GameCategory,
 def csrf_protect():
     """Abort create, update and delete requests without correct csrf tokens."""
     if request.method in ('POST', 'PATCH', 'DELETE'):
-        print 'validating csrf token'
+        app.logger.debug('validating csrf token')
         token = session.get('_csrf_token')
         token_from_json = request.get_json().get(
             '_csrf_token') if request.get_json() else None
@@ -37,16 +164,16 @@ def csrf_protect():
             not token or
             token not in (request.form.get('_csrf_token'), token_from_json)
         ):
-            print 'failed csrf token test'
+            app.logger.info('failed csrf token test')
             abort(403)
         else:
-            print 'csrf token ok'
+            app.logger.debug('csrf token ok')
 
 
 def generate_csrf_token():
     """Add csrf token to the session and return the csrf token."""
     if '_csrf_token' not in session:
-        print 'generating csrf token'
+        app.logger.debug('generating csrf token')
         session['_csrf_token'] = random_string()
     return session['_csrf_token']
 
@@ -57,7 +184,24 @@ def random_string():
     return ''.join([chars[random.randint(0, 61)] for i in range(20)])
 
 
+def conditional_page(view):
+    """Apply conditional to a view rendering pages with the csrf token.
+
+    The token is created before the ETag is computed, so that the ETag
+    given on the first visit already covers it.
+    """
+    conditional_view = conditional(view)
+
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if request.method == 'GET':
+            generate_csrf_token()
+        return conditional_view(*args, **kwargs)
+    return wrapper
+
+
 app.jinja_env.globals['csrf_token'] = generate_csrf_token
+app.jinja_env.add_extension(FragmentCacheExtension)
 
 
 ###############################
@@ -70,6 +214,21 @@ def remove_session(exception=None):
     db_session.remove()
 
 
+@app.before_first_request
+def check_schema():
+    """Warn if the database lacks primary keys, indexes or full-text search
+    of the models.
+    """
+    missing_pks, missing_indexes, missing_search = missing_schema_items()
+    if missing_pks or missing_indexes or missing_search:
+        app.logger.warning(
+            'Database is missing primary keys on: %s, indexes: %s and '
+            'full-text search: %s; run bgc_init_db to upgrade it',
+            ', '.join(table.name for table in missing_pks) or '-',
+            ', '.join(index.name for index in missing_indexes) or '-',
+            'yes' if missing_search else 'no')
+
+
 ####################################
 # Authentication and authorisation #
 ####################################
@@ -83,29 +242,54 @@ def ownership_required():
         request.endpoint in ('profile_game_add', 'club_game_add') or
         request.method in ('PATCH', 'DELETE')
     ):
-        print 'checking ownership'
+        app.logger.debug('checking ownership')
         if 'user_id' not in session or not check_ownership():
             abort(403)
         else:
-            print 'ownership ok'
+            app.logger.debug('ownership ok')
+
+
+# Admin status by user id, with the admins generation it was read at
+admin_cache = LRUCache(app.config['ADMIN_CACHE_SIZE'],
+                       app.config['ADMIN_CACHE_TTL'])
+
+
+def is_admin(user_id):
+    """Return True if the user is a club admin.
+
+    The status is cached per user until the admins generation changes;
+    it is bumped whenever an admin is added or a user deleted.
+    """
+    generation = current_generations().get('admins', 0)
+    entry = admin_cache.get(user_id)
+    if entry is not None and entry[0] == generation:
+        return entry[1]
+    admin = db_session.query(ClubAdmin.id).filter_by(
+        user_id=user_id).scalar() is not None
+    admin_cache.set(user_id, (generation, admin))
+    return admin
 
 
 def check_ownership():
-    """Verify if the user is the owner of the requested resource."""
+    """Verify if the user is the owner of the requested resource.
+
+    A post loaded to check its ownership is stored in g.post for the
+    view function.
+    """
     user_id = session.get('user_id')
     if not user_id:
         return False
     elif 'club_' in request.endpoint or 'home' in request.endpoint:
-        admin = ClubAdmin.query.filter_by(user_id=user_id).scalar()
-        return True if admin else False
+        return is_admin(user_id)
     elif 'profile_' in request.endpoint:
         return request.view_args['user_id'] == user_id
     elif request.endpoint == 'post_':
-        owned_post = Post.query.filter_by(
-            id=request.view_args['post_id'], user_id=user_id).scalar()
-        return True if owned_post else False
+        g.post = Post.query.filter_by(
+            id=request.view_args['post_id']).scalar()
+        return g.post is not None and g.post.user_id == user_id
     else:
-        print 'Unable to verify ownership'
+        app.logger.warning('Unable to verify ownership for %s',
+                           request.endpoint)
         return False
 
 
@@ -120,26 +304,22 @@ def login_required():
         abort(401)
 
 
-def validate_id_token(token, token_jwt):
+def validate_id_token(token_jwt):
     """Validate id_token as per
     https://developers.google.com/identity/protocols/OpenIDConnect.
-    """
-    url = 'https://www.googleapis.com/oauth2/v3/tokeninfo'
-    params = 'id_token={}'.format(token_jwt)
-    r = requests.get(url, params=params)
 
-    if (
-        # Is the token properly signed by the issuer?
-        r.status_code == 200 and r.json()['aud'] == token['aud'] and
-        # Was it issued by google?
-        token['iss'] in ('https://accounts.google.com',
-                         'accounts.google.com') and
-        # Is it intended for this app?
-        token['aud'] == app.config['CLIENT_ID'] and
-        # Is it still valid (not expired)?
-        token['exp'] > int(time.time())
-    ):
-        return True
+    The signature is verified locally against the cached signing keys
+    of Google; see boardgameclub.google_auth.
+
+    Returns:
+        Dictionary of the claims of the token or None if not valid.
+    """
+    try:
+        return verify_id_token(token_jwt, app.config['CLIENT_ID'],
+                               google_keys)
+    except TokenError as e:
+        app.logger.warning('Invalid id token: %s', e)
+        return None
 
 
 ##################################################
@@ -160,6 +340,14 @@ def error_response(err_msg, code):
     return err_response
 
 
+@app.errorhandler(BGGError)
+def bgg_unavailable(error):
+    """Respond with 504 if the bgg API fails or does not answer in time."""
+    app.logger.error('%s', error)
+    return error_response('BoardGameGeek is not available, try again later.',
+                          504)
+
+
 def bgg_game_options(bg_name):
     """Search for games on bgg API by name and return all the matching options.
 
@@ -169,60 +357,17 @@ def bgg_game_options(bg_name):
     Returns:
         List of dictionaries. Each dictionary holds basic info about a game.
     """
-    bgg_games = []
-    url = 'https://boardgamegeek.com/xmlapi2/search'
-    payload = {'query': bg_name, 'type': 'boardgame'}
-    r = requests.get(url, params=payload)
-    print r.url
-    # Parse the xml response
-    root = ElementTree.fromstring(r.content)
-    for item in root.findall('item'):
-        bgg_id = item.get('id')
-        game_name = item.find('name').get('value')
-        try:
-            year = item.find('yearpublished').get('value')
-        except AttributeError:
-            year = ''
-        bgg_games.append({'id': bgg_id, 'name': game_name, 'year': year})
-    return bgg_games
+    return bgg_client.search(bg_name)
 
 
-def bgg_game_info(bgg_id):
+def bgg_game_info(bgg_id, fresh=False):
     """Get game info from bgg API; return dictionary with game info and
-    list of game category objects .
-    """
-    game_info = {'bgg_id': bgg_id}
-    url = 'https://www.boardgamegeek.com/xmlapi2/thing'
-    payload = {'id': bgg_id, 'stats': 1}
-    r = requests.get(url, params=payload)
-    # Parse the xml response
-    root = ElementTree.fromstring(r.content)[0]
-    # name
-    for name in root.findall('name'):
-        if name.get('type') == 'primary':
-            game_info['name'] = name.get('value')
-    # image
-    game_info['image'] = root.find('image').text
-    # complexity/weight
-    game_info['weight'] = root.find('statistics').find('ratings').find(
-        'averageweight').get('value')
-    # bgg_rating
-    game_info['bgg_rating'] = root.find('statistics').find('ratings').find(
-        'average').get('value')
-    # other properties
-    properties = ['year_published', 'min_age', 'min_playtime', 'max_playtime',
-                  'min_players', 'max_players']
-    for bg_prop in properties:
-        game_info[bg_prop] = root.find(bg_prop.replace('_', '')).get('value')
-
-    game_info['bgg_link'] = 'https://boardgamegeek.com/boardgame/{}'.format(
-        bgg_id)
-    # categories
-    categories = []
-    for link in root.findall('link'):
-        if link.get('type') == 'boardgamecategory':
-            categories.append(check_game_category(link.get('value')))
-    return game_info, categories
+    list of game category objects. Set fresh to bypass the BGG cache.
+    """
+    game_info = bgg_client.thing(bgg_id, fresh)
+    category_names = game_info.pop('categories')
+    categories = resolve_categories(category_names)
+    return game_info, [categories[name] for name in set(category_names)]
 
 
 def check_user(email, name, picture):
@@ -232,46 +377,78 @@ def check_user(email, name, picture):
     user = User.query.filter_by(email=email).scalar()
     new_user = False
     if not user:
-        print 'adding new user to the db'
+        app.logger.info('adding new user to the db')
         user = User(email=email, name=name, picture=picture)
         db_session.add(user)
+        # Get the id before the commit expires the object
+        db_session.flush()
+        user_id = user.id
+        bump_generation()
         db_session.commit()
-        user = User.query.filter_by(email=email).scalar()
         new_user = True
     else:
-        print 'user already exists'
-    return user.id, new_user
+        app.logger.debug('user already exists')
+        user_id = user.id
+    return user_id, new_user
+
+
+def resolve_categories(category_names):
+    """Get game categories with the given names from the database, adding
+    the missing ones within the current transaction.
 
+    Existing categories are selected with one query and the missing ones
+    are added with one multi-row insert which skips categories added
+    concurrently by another request.
+
+    Args:
+        category_names (iterable): names of the game categories.
 
-def check_game_category(category_name):
-    """Check if the game category is already in the database;
-    if not, make a new entry. Return the category.
+    Returns:
+        Dictionary mapping category name to GameCategory object.
     """
-    category = GameCategory.query.filter_by(name=category_name).scalar()
-    if not category:
-        new_category = GameCategory(name=category_name)
-        db_session.add(new_category)
-        db_session.commit()
-        category = GameCategory.query.filter_by(name=category_name).scalar()
-    return category
+    names = set(category_names)
+    if not names:
+        return {}
+    categories = dict(
+        (category.name, category) for category in
+        GameCategory.query.filter(GameCategory.name.in_(names)))
+    missing = names.difference(categories)
+    if missing:
+        db_session.execute(insert_ignore(GameCategory.__table__).values(
+            [{'name': name} for name in missing]))
+        categories.update(
+            (category.name, category) for category in
+            GameCategory.query.filter(GameCategory.name.in_(missing)))
+    return categories
 
 
 def check_game(bgg_id):
     """Check if the game is already in the database;
     if not, make a new entry. Return the game.
+
+    Concurrent requests for the same new game share a single bgg API
+    request and the unique bgg_id constraint guarantees that only one
+    of them inserts the game.
     """
     bgame = Game.query.filter_by(bgg_id=bgg_id).scalar()
     if not bgame:
         # Get the game info from bgg API
         game_info, bgg_categories = bgg_game_info(bgg_id)
-        # Add the game to the database
-        bgame = Game(**game_info)
-        bgame.categories = bgg_categories
-        db_session.add(bgame)
+        # Add the game to the database unless it has just been added
+        result = db_session.execute(
+            insert_ignore(Game.__table__).values(**game_info))
+        bgame = Game.query.filter_by(bgg_id=bgg_id).one()
+        if result.rowcount:
+            bgame.categories = bgg_categories
+            db_session.flush()
+            similar.update_games([bgame.id])
+            bump_generation()
+            app.logger.info('Game %s added to the database', bgg_id)
         db_session.commit()
-        print 'Game added to the database!'
+        if result.rowcount and game_index:
+            game_index.update(bgame)
     else:
-        print 'Game already in the database'
+        app.logger.debug('Game %s already in the database', bgg_id)
     return bgame
 
 
@@ -279,25 +456,24 @@ def make_posts_read(posts):
     """Prepare data on a set of posts for the template engine.
 
     Args:
-        posts (list): list of Post objects.
+        posts (list): list of rows with post columns and the author's
+            name and picture as author_name and author_picture.
 
     Returns:
          List of dictionaries. Each dictionary holds all the post data
          required by the template engine.
     """
     posts_read = []
-    user_id = session.get('user_id')
     for post in posts:
-        user = post.author
         post_dict = {
             'id': post.id,
             'subject': post.subject,
             'body': post.body,
-            'author': user.name,
-            'author_picture': user.picture,
+            'author': post.author_name,
+            'author_picture': post.author_picture,
             'posted': time.strftime("%d/%m/%Y, %H:%M",
                                     time.gmtime(post.posted)),
-            'owner': post.user_id == user_id
+            'user_id': post.user_id
         }
         if post.edited:
             post_dict['edited'] = time.strftime("%d/%m/%Y, %H:%M",
@@ -306,66 +482,106 @@ def make_posts_read(posts):
     return posts_read
 
 
-def game_query_builder(key, value, query, param_dict):
-    """Modify textual sql query in order take into account an additional
-    WHERE condition.
+def keyset_page(query, key_column, cursor, page_size, descending=False):
+    """Get one page of query results using keyset pagination.
 
     Args:
-        key (str): condition name.
-        value (str): condition value.
-        query (str): textual SQL statement.
-        param_dict (dict): dict with params for textual SQL statement.
+        query: Query object selecting rows with an 'id' attribute.
+        key_column: unique column by which the rows are ordered.
+        cursor (int): key of the last row of the previous page or None
+            for the first page.
+        page_size (int): number of rows per page.
+        descending (bool): order rows by descending key.
 
     Returns:
-        str: modified SQL query.
-    """
-    d = {'id': 'id in (:{val})',
-         'name': 'name LIKE :{val}',
-         'rating-min': 'bgg_rating>=:{val}',
-         'players-from': 'min_players<=:{val}',
-         'players-to': 'max_players>=:{val}',
-         'time-from': 'max_playtime>=:{val}',
-         'time-to': 'min_playtime<=:{val}',
-         'weight-min': 'weight>=:{val}',
-         'weight-max': 'weight<=:{val}',
-         }
-    if len(value) == 0 or value == 'any' or not d.get(key):
-        # Do nothing
-        return query, param_dict
-    # Add condition value to param_dict
-    param_key = 'val_{}'.format(len(param_dict) + 1)
-    if key == 'name':
-        value = '{}%'.format(value)
-    param_dict[param_key] = value
-    # Modify SQL statement
-    if key == 'id' and 'id in' in query:
-        pos = query.find(')', query.find('id in'))
-        query = query[:pos] + ', :' + param_key + query[pos:]
-    else:
-        query = query + d[key].format(val=param_key) + ' AND '
-    return query, param_dict
+        tuple: list of rows and cursor of the next page or None if this
+            is the last page.
+    """
+    if cursor is not None:
+        query = query.filter(
+            key_column < cursor if descending else key_column > cursor)
+    query = query.order_by(key_column.desc() if descending else key_column)
+    rows = query.limit(page_size + 1).all()
+    if len(rows) > page_size:
+        return rows[:page_size], rows[page_size - 1].id
+    return rows, None
 
 
-def clear_games(*games):
-    """Remove orphaned games from the database.
+def page_url(cursor_arg, cursor, own_arg_only=False):
+    """Return URL of the current page with the cursor arg replaced.
 
-    If any of the games is not owned by any user or the club,
-    remove it from the database.
+    Args:
+        cursor_arg (str): name of the query arg holding the cursor.
+        cursor: cursor of the next page or None if there is none.
+        own_arg_only (bool): True to drop the other query args of the
+            current page, e.g. for links in cached fragments which must
+            not depend on the request rendering them.
     """
-    for game in games:
-        if len(game.users) == 0 and len(game.clubs) == 0:
-            categories = game.categories
-            db_session.delete(game)
-            db_session.commit()
-            clear_categories(*categories)
+    if cursor is None:
+        return None
+    args = {} if own_arg_only else request.args.to_dict()
+    args.update(request.view_args)
+    args[cursor_arg] = cursor
+    return url_for(request.endpoint, **args)
 
 
-def clear_categories(*categories):
-    """Remove orphaned game categories from the database"""
-    for category in categories:
-        if len(category.games) == 0:
-            db_session.delete(category)
-            db_session.commit()
+def clear_games(*game_ids):
+    """Remove orphaned games and game categories from the database.
+
+    A game is orphaned if it is not owned by any user or the club and a
+    game category is orphaned if no game belongs to it. Orphans are
+    removed with set-based deletes in a single transaction which also
+    commits any pending changes of the caller.
+
+    Args:
+        *game_ids: ids of the games to be checked; if none are given,
+            all the games in the database are checked, which is meant
+            for bgc_sweep rather than for requests.
+
+    Returns:
+        int: number of removed games.
+    """
+    def orphaned(game_id_column, chunk):
+        """Return WHERE clause matching ids of orphaned games."""
+        clause = sqlalchemy.and_(
+            ~sqlalchemy.exists().where(
+                users_games_assoc.c.game_id == game_id_column),
+            ~sqlalchemy.exists().where(
+                clubs_games_assoc.c.game_id == game_id_column))
+        if chunk is not None:
+            clause = sqlalchemy.and_(clause, game_id_column.in_(chunk))
+        return clause
+
+    # Apply pending changes of the caller, e.g. games removed from a
+    # collection, before looking for orphans
+    db_session.flush()
+    games = Game.__table__
+    categories = GameCategory.__table__
+    if game_ids:
+        game_ids = list(game_ids)
+        chunks = [game_ids[i:i + 500] for i in range(0, len(game_ids), 500)]
+    else:
+        chunks = [None]
+    removed_ids = []
+    for chunk in chunks:
+        removed_ids.extend(row.id for row in db_session.execute(
+            sqlalchemy.select([games.c.id]).where(
+                orphaned(games.c.id, chunk))))
+    if removed_ids:
+        similar.update_games(removed_ids, removed=True)
+    removed = 0
+    for chunk in chunks:
+        db_session.execute(games_categories_assoc.delete().where(
+            orphaned(games_categories_assoc.c.game_id, chunk)))
+        removed += db_session.execute(games.delete().where(
+            orphaned(games.c.id, chunk))).rowcount
+    db_session.execute(categories.delete().where(~sqlalchemy.exists().where(
+        games_categories_assoc.c.category_id == categories.c.id)))
+    bump_generation()
+    db_session.commit()
+    if game_index:
+        game_index.remove(removed_ids)
+    return removed
 
 
 def patch_resource(attributes, my_obj):
@@ -380,6 +596,7 @@ def patch_resource(attributes, my_obj):
     for attribute in attributes:
         setattr(my_obj, attribute['name'], attribute['value'])
     db_session.add(my_obj)
+    bump_generation()
     db_session.commit()
 
 
@@ -394,74 +611,179 @@ def validate_api_game_query(query_dict):
     Returns:
         bool: True if all keys and values are valid, False otherwise.
     """
-    args_int = ['club', 'user', 'id', 'category', 'rating-min', 'players-from',
-                'players-to', 'time-from', 'time-to', 'weight-min',
-                'weight-max']
-    args_other = ['name']
-    args_dupl = ['user', 'id', 'category']
-    for key, value in query_dict.iteritems(multi=True):
-        if(
+    args_paging = ['sort', 'after', 'format', 'limit', 'facets']
+    for key, values in query_dict.iterlists():
+        if (
             # Check if any of the keys is invalid
-            key not in args_int + args_other or
-            # Check if any of the values is invalid
-            key in args_int and not value.isdigit()
+            key not in filters.FILTERS and key not in args_paging or
+            # Check if there are any non-allowed key duplicates
+            len(values) > 1 and not (
+                key in filters.FILTERS and filters.FILTERS[key].multiple)
         ):
             return False
-    # Check if there are any non-allowed key duplicates
-    for key, values in query_dict.iterlists():
-        if key not in args_dupl and len(values) > 1:
-            return False
+    # Check if any of the filter values is invalid
+    try:
+        values = filters.parse_args(query_dict)
+    except filters.FilterError:
+        return False
+    # Validate paging and format args
+    if (
+        query_dict.get('sort', 'id').lstrip('-') not in filters.SORT_KEYS or
+        query_dict.get('sort', '').lstrip('-') == 'relevance' and
+        'name' not in values or
+        query_dict.get('format', 'json') not in ('json', 'ndjson') or
+        query_dict.get('facets', '0') not in ('0', '1') or
+        query_dict.get('facets') == '1' and
+        query_dict.get('format') == 'ndjson' or
+        'limit' in query_dict and not (
+            query_dict['limit'].isdigit() and
+            0 < int(query_dict['limit']) <= app.config['API_GAMES_MAX_LIMIT']
+        ) or
+        'after' in query_dict and (
+            decode_cursor(query_dict['after']) is None or
+            not filters.valid_cursor(
+                query_dict.get('sort', filters.default_sort(values)),
+                decode_cursor(query_dict['after'])))
+    ):
+        return False
     # Validate players-to and players-from
     players = ['players-from', 'players-to']
     if not(
         # None of the two keys is present
-        not any([x in query_dict for x in players]) or
+        not any([x in values for x in players]) or
         # Both keys are present and ...
-        all([x in query_dict for x in players]) and
+        all([x in values for x in players]) and
         # ... their values are valid
-        int(query_dict['players-to']) >= int(query_dict['players-from'])
+        values['players-to'] >= values['players-from']
     ):
         return False
     return True
 
 
-def dicts_purge(p_dicts, *keep_keys):
-    """Purge dictionaries of unwanted key:value pairs.
+def validate_api_planner_query(query_dict):
+    """Validate keys and values of the game-night planner query.
 
     Args:
-        p_dicts (list): list of dicts to be purged.
-        *keep_keys: list of keys to be kept.
+        query_dict (MultiDict): query args.
 
     Returns:
-        List of purged dicts.
+        bool: True if all keys and values are valid, False otherwise.
     """
-    for p_dict in p_dicts:
-        for key in p_dict.keys():
-            if key not in keep_keys:
-                del p_dict[key]
-    return p_dicts
+    for key, values in query_dict.iterlists():
+        if (
+            key not in ('user', 'club', 'players', 'time') or
+            len(values) > 1 and key != 'user' or
+            not all(value.isdigit() for value in values)
+        ):
+            return False
+    # At least one attendee and at least one player
+    return (
+        ('user' in query_dict or 'club' in query_dict) and
+        int(query_dict.get('players', len(query_dict.getlist('user')))) > 0
+    )
 
 
-def sql_to_dicts(*games):
-    """Convert Game objects to dictionaries.
+def encode_cursor(values):
+    """Encode list of JSON-serializable values as an opaque cursor."""
+    values = [float(value) if type(value) == Decimal else value
+              for value in values]
+    return base64.urlsafe_b64encode(json.dumps(values))
 
-    Each column-name:value pair in an object is converted to a
-    key:value pair in the corresponding dictionary.
+
+def decode_cursor(cursor):
+    """Decode cursor made by encode_cursor; return None if invalid."""
+    try:
+        values = json.loads(base64.urlsafe_b64decode(str(cursor)))
+    except (TypeError, ValueError):
+        return None
+    return values if isinstance(values, list) and len(values) == 2 else None
+
+
+def stream_games(result):
+    """Yield games as lines of newline delimited JSON.
 
     Args:
-        *games: list of Game objects.
+        result: ResultProxy returned by filters.search_rows.
+    """
+    while True:
+        rows = result.fetchmany(app.config['API_GAMES_STREAM_BATCH'])
+        if not rows:
+            break
+        for game_dict in games_dicts(rows):
+            yield json_dumps(game_dict) + '\n'
+
+
+def rows_to_dicts(rows, columns):
+    """Convert result rows to dictionaries.
+
+    Args:
+        rows (list): rows selecting the columns.
+        columns (list): Column objects to be included; they are keyed
+            by the column keys.
 
     Returns:
-        list of dictionaries.
+        List of dictionaries; Decimal values are converted to floats.
     """
-    sql_dicts = []
-    for game in games:
-        keys = game.__table__.columns.keys()
-        values = [getattr(game, key) for key in keys]
+    keys = [column.key for column in columns]
+    dicts = []
+    for row in rows:
+        values = [row[column] for column in columns]
         values = [float(value) if type(value) == Decimal
                   else value for value in values]
-        sql_dicts.append(dict(zip(keys, values)))
-    return sql_dicts
+        dicts.append(dict(zip(keys, values)))
+    return dicts
+
+
+def load_category_names(game_ids):
+    """Load names of the categories of many games at once.
+
+    Args:
+        game_ids (list): ids of the games.
+
+    Returns:
+        Dictionary mapping game id to list of names of its categories.
+    """
+    names = dict((game_id, []) for game_id in game_ids)
+    # Bounded number of bind parameters per statement
+    for i in range(0, len(game_ids), 500):
+        for game_id, name in db_session.execute(sqlalchemy.select(
+                [games_categories_assoc.c.game_id, GameCategory.name])
+                .select_from(games_categories_assoc.join(GameCategory))
+                .where(games_categories_assoc.c.game_id.in_(
+                    game_ids[i:i + 500]))):
+            names[game_id].append(name)
+    return names
+
+
+def games_dicts(rows):
+    """Convert rows returned by filters.search_rows to dictionaries
+    with all the game columns and the names of the game's categories.
+    """
+    games_dict = rows_to_dicts(rows, Game.__table__.columns)
+    names = load_category_names([game_dict['id'] for game_dict in games_dict])
+    for game_dict in games_dict:
+        game_dict['category'] = names[game_dict['id']]
+    return games_dict
+
+
+def json_dumps(data):
+    """Serialize data to JSON, with ujson if installed."""
+    if ujson is None:
+        return json.dumps(data)
+    return ujson.dumps(data, escape_forward_slashes=False)
+
+
+def fast_jsonify(**data):
+    """Return JSON response with the data.
+
+    Equivalent to jsonify, but encoded with ujson if installed, which
+    is considerably faster on large responses.
+    """
+    if ujson is None:
+        return jsonify(**data)
+    return app.response_class(
+        ujson.dumps(data, escape_forward_slashes=False, sort_keys=True) +
+        '\n', mimetype=app.config['JSONIFY_MIMETYPE'])
 
 
 def sign_out():
@@ -473,17 +795,16 @@ def sign_out():
             params={'token': session['access_token']},
             headers={'content-type': 'application/x-www-form-urlencoded'})
         if r.status_code != 200:
-            print 'Failed to revoke access token'
-            print r.text
+            app.logger.warning('Failed to revoke access token: %s', r.text)
         # Delete user info from session
         del session['email']
         del session['username']
         del session['access_token']
         del session['user_id']
         del session['_csrf_token']
-        print 'Signed out'
+        app.logger.debug('Signed out')
     except KeyError:
-        print 'Not signed in'
+        app.logger.debug('Not signed in')
         abort(401)
 
 
@@ -492,14 +813,53 @@ def sign_out():
 ##################
 
 @app.route('/')
+@conditional_page
 def home():
-    """Return the app's main page."""
+    """Return the app's main page.
+
+    Posts (newest first), members and club's games are paginated with
+    the posts-before, members-after and games-after query args. Each
+    page of them is loaded by the template only if its fragment is not
+    cached.
+    """
     club = Club.query.filter_by(id=1).scalar()
-    members = User.query.all()
-    posts = Post.query.all()
-    posts_read = make_posts_read(posts)
-    return render_template('club.html', club=club, posts=posts_read,
-                           members=members, games=club.games,
+    posts_before = request.args.get('posts-before', type=int)
+    members_after = request.args.get('members-after', type=int)
+    games_after = request.args.get('games-after', type=int)
+
+    def load_posts():
+        """Return page of posts with their authors and next page URL."""
+        posts_query = db_session.query(
+            Post.id, Post.user_id, Post.subject, Post.body, Post.posted,
+            Post.edited, User.name.label('author_name'),
+            User.picture.label('author_picture')).join(Post.author)
+        posts, posts_next = keyset_page(
+            posts_query, Post.id, posts_before,
+            app.config['POSTS_PER_PAGE'], descending=True)
+        return make_posts_read(posts), page_url(
+            'posts-before', posts_next, own_arg_only=True)
+
+    def load_members():
+        """Return page of members and next page URL."""
+        members, members_next = keyset_page(
+            db_session.query(User.id, User.name), User.id, members_after,
+            app.config['MEMBERS_PER_PAGE'])
+        return members, page_url('members-after', members_next,
+                                 own_arg_only=True)
+
+    def load_games():
+        """Return page of club's games and next page URL."""
+        games_query = db_session.query(*GAMES_TABLE_COLUMNS).join(
+            clubs_games_assoc).filter(clubs_games_assoc.c.club_id == club.id)
+        games, games_next = keyset_page(
+            games_query, Game.id, games_after, app.config['GAMES_PER_PAGE'])
+        return games, page_url('games-after', games_next, own_arg_only=True)
+
+    return render_template('club.html', club=club,
+                           posts_before=posts_before, load_posts=load_posts,
+                           members_after=members_after,
+                           load_members=load_members,
+                           games_after=games_after, load_games=load_games,
                            owner=check_ownership())
 
 
@@ -526,10 +886,12 @@ def club_game_add():
     else:
         # Add the chosen game to the database
         game = check_game(request.form['bgg-id'])
-        club = Club.query.filter_by(id=1).scalar()
-        club.games.append(game)
-        db_session.add(club)
+        db_session.execute(insert_ignore(clubs_games_assoc).values(
+            club_id=1, game_id=game.id))
+        bump_generation()
         db_session.commit()
+        if game_index:
+            game_index.add_owner(('club', 1), game.id)
         flash('Game added to the collection!')
         return redirect(url_for('home'))
 
@@ -543,8 +905,9 @@ def club_game_(game_id):
     except sqlalchemy.orm.exc.NoResultFound:
         abort(404)
     club.games.remove(game)
-    db_session.commit()
-    clear_games(game)
+    clear_games(game_id)
+    if game_index:
+        game_index.remove_owner(('club', 1), game_id)
     flash('Game removed from the collection!')
     return '', 204
 
@@ -567,6 +930,7 @@ def post_add():
         }
         post = Post(**post_data)
         db_session.add(post)
+        bump_generation('posts')
         db_session.commit()
         flash('Post created!')
         return redirect(url_for('home'))
@@ -578,7 +942,8 @@ def post_(post_id):
 
     Use PATCH and DELETE methods respectively.
     """
-    post = Post.query.filter_by(id=post_id).scalar()
+    # Loaded by check_ownership
+    post = g.post
     if request.method == 'PATCH':
         # Update Post
         attributes = request.get_json()['data']['attributes']
@@ -589,6 +954,7 @@ def post_(post_id):
     else:
         # Delete Post
         db_session.delete(post)
+        bump_generation('posts')
         db_session.commit()
         flash('Post deleted!')
         return '', 204
@@ -605,6 +971,7 @@ def profile_add(user_id):
 
 
 @app.route('/users/<int:user_id>', methods=['GET', 'PATCH', 'DELETE'])
+@conditional_page
 def profile_(user_id):
     """Return user's profile page or Update Profile or Delete Profile.
 
@@ -616,7 +983,8 @@ def profile_(user_id):
         abort(404)
     if request.method == 'GET':
         # Return user's profile page
-        return render_template('profile.html', user=user, games=user.games,
+        return render_template('profile.html', user=user,
+                               load_games=lambda: user.games,
                                owner=check_ownership())
     elif request.method == 'PATCH':
         # Update Profile
@@ -626,10 +994,24 @@ def profile_(user_id):
         return '', 204
     else:
         # Delete Profile
-        games = user.games
+        game_ids = [row.game_id for row in db_session.execute(
+            sqlalchemy.select([users_games_assoc.c.game_id]).where(
+                users_games_assoc.c.user_id == user_id))]
+        db_session.execute(users_games_assoc.delete().where(
+            users_games_assoc.c.user_id == user_id))
         db_session.delete(user)
-        db_session.commit()
-        clear_games(*games)
+        # The user may have been an admin and the id may be reused
+        bump_generation('admins')
+        if app.config['DEFER_ORPHAN_SWEEP'] or not game_ids:
+            # Nothing to sweep or orphaned games are removed later by
+            # bgc_sweep
+            bump_generation()
+            db_session.commit()
+        else:
+            # Only the user's games may have become orphaned
+            clear_games(*game_ids)
+        if game_index:
+            game_index.remove_owner(('user', user_id))
         sign_out()
         flash('Profile deleted!')
         return '', 204
@@ -648,10 +1030,12 @@ def profile_game_add(user_id):
     else:
         # Add the chosen game to the database
         game = check_game(request.form['bgg-id'])
-        user = User.query.filter_by(id=user_id).scalar()
-        user.games.append(game)
-        db_session.add(user)
+        db_session.execute(insert_ignore(users_games_assoc).values(
+            user_id=user_id, game_id=game.id))
+        bump_generation()
         db_session.commit()
+        if game_index:
+            game_index.add_owner(('user', user_id), game.id)
         flash('Game added to the collection!')
         return redirect(url_for('profile_', user_id=user_id))
 
@@ -665,13 +1049,15 @@ def profile_game_(user_id, game_id):
     except sqlalchemy.orm.exc.NoResultFound:
         abort(404)
     user.games.remove(game)
-    db_session.commit()
-    clear_games(game)
+    clear_games(game_id)
+    if game_index:
+        game_index.remove_owner(('user', user_id), game_id)
     flash('Game removed from the collection!')
     return '', 204
 
 
 @app.route('/games/<int:game_id>', methods=['GET', 'POST'])
+@conditional_page
 def game_(game_id):
     """Return game page or Update Game.
 
@@ -683,50 +1069,183 @@ def game_(game_id):
         abort(404)
     if request.method == 'GET':
         # Return game page
-        return render_template('game.html', game=bgame)
+        return render_template(
+            'game.html', game=bgame,
+            load_similar_games=lambda: find_similar_games(game_id))
     else:
         # Update game info from bgg API
-        game_info, bgg_categories = bgg_game_info(bgame.bgg_id)
+        game_info, bgg_categories = bgg_game_info(bgame.bgg_id, fresh=True)
         for key, value in game_info.iteritems():
             setattr(bgame, key, value)
         bgame.categories = bgg_categories
+        db_session.flush()
+        similar.update_games([game_id])
+        bump_generation()
         db_session.commit()
+        if game_index:
+            game_index.update(bgame)
         flash('Game info updated!')
         return redirect(url_for('game_', game_id=game_id))
 
 
+def count_facets(values):
+    """Count games satisfying the filters by category, number of
+    players, weight band and playing time band.
+
+    The counts come from the game index if it can answer the filters
+    or from a single aggregate query otherwise.
+
+    Args:
+        values (dict): filter values as returned by filters.parse_args.
+
+    Returns:
+        Dictionary of counts as returned by filters.count_facets.
+    """
+    if game_index and game_index.covers(values):
+        return game_index.count_facets(values)
+    return filters.count_facets(values)
+
+
+def facets_dicts(facets):
+    """Convert facet counts to lists of dictionaries for JSON and the
+    template engine.
+
+    Categories with no games are left out; every number of players and
+    band is listed. Bands are given by their bounds: min < value <= max,
+    where None stands for no bound.
+    """
+    names = dict(db_session.query(GameCategory.id, GameCategory.name).filter(
+        GameCategory.id.in_(facets['category']))) if (
+        facets['category']) else {}
+    facets_dict = {
+        'categories': sorted(
+            [{'id': category_id, 'name': names.get(category_id),
+              'count': count}
+             for category_id, count in facets['category'].iteritems()],
+            key=lambda category: (-category['count'], category['name'])),
+        'players': [{'players': n, 'count': facets['players'].get(n, 0)}
+                    for n in filters.PLAYER_COUNTS]
+    }
+    for name, bounds in [('weight', filters.WEIGHT_BANDS),
+                         ('time', filters.TIME_BANDS)]:
+        lower = (None,) + bounds
+        upper = bounds + (None,)
+        facets_dict[name] = [
+            {'min': lower[i], 'max': upper[i],
+             'count': facets[name].get(i, 0)}
+            for i in range(len(bounds) + 1)]
+    return facets_dict
+
+
+def find_similar_games(game_id):
+    """Return rows with the columns displayed in the games table and
+    the similarity score of the games most similar to the game, best
+    first.
+    """
+    return (db_session.query(*GAMES_TABLE_COLUMNS + (
+            similar_games_assoc.c.score,))
+            .join(similar_games_assoc,
+                  similar_games_assoc.c.similar_id == Game.id)
+            .filter(similar_games_assoc.c.game_id == game_id)
+            .order_by(similar_games_assoc.c.score.desc(), Game.id).all())
+
+
+def find_indexed_games(values):
+    """Find games satisfying the filters using the game index.
+
+    Only the games matching the filters are loaded from the database
+    and only with the columns displayed in the games table.
+
+    Args:
+        values (dict): filter values as returned by filters.parse_args.
+
+    Returns:
+        List of rows ordered by game id.
+    """
+    game_ids = game_index.search(values)
+    games = []
+    for i in range(0, len(game_ids), 500):
+        games.extend(db_session.query(*GAMES_TABLE_COLUMNS)
+                     .filter(Game.id.in_(game_ids[i:i + 500]))
+                     .order_by(Game.id))
+    return games
+
+
+def find_owners(game_ids, owners):
+    """Find which of the owners own each of the games.
+
+    Args:
+        game_ids (list): ids of the games.
+        owners (list): ('user', user_id) and ('club', club_id) tuples.
+
+    Returns:
+        Dictionary mapping game id to list of its owners.
+    """
+    if game_index:
+        return game_index.owners(game_ids, owners)
+    game_owners = dict((game_id, []) for game_id in game_ids)
+    for kind, table, owner_column in [
+            ('user', users_games_assoc, users_games_assoc.c.user_id),
+            ('club', clubs_games_assoc, clubs_games_assoc.c.club_id)]:
+        owner_ids = [owner_id for owner_kind, owner_id in owners
+                     if owner_kind == kind]
+        if not owner_ids:
+            continue
+        # Collections of the attendees are small; select them whole
+        for owner_id, game_id in db_session.execute(sqlalchemy.select(
+                [owner_column, table.c.game_id]).where(
+                owner_column.in_(owner_ids))):
+            if game_id in game_owners:
+                game_owners[game_id].append((kind, owner_id))
+    return game_owners
+
+
 @app.route('/games/search')
 def game_finder():
-    """Return game-finder page."""
-    all_categories = GameCategory.query.all()
-    games = []
+    """Return game-finder page.
+
+    The search form and results are loaded by the template only if
+    their fragment, cached under the normalized filter values, is not
+    cached.
+    """
+    values = None
     if len(request.args) > 0:
-        # Build SQL query
-        query = ''
-        param_dict = {}
-        for key, value in request.args.iteritems():
-            query, param_dict = game_query_builder(key, value, query,
-                                                   param_dict)
-        query = query[:-5]
-        print query
-        print param_dict
-        # Get games satisfying the search criteria
-        game_category = int(request.args['category'])
-        if game_category == 0:
-            games = Game.query.filter(sqlalchemy.text(query).params(
-                param_dict)).all()
+        try:
+            values = filters.parse_args(request.args)
+        except filters.FilterError:
+            flash('Invalid search criteria!')
+        else:
+            # Category 0 stands for any category
+            if values.get('category') == [0]:
+                del values['category']
+    # Same filters given in any order or repeated find the same games
+    search = None if values is None else sorted(
+        (arg, sorted(set(value)) if isinstance(value, list) else value)
+        for arg, value in values.iteritems())
+
+    def load_results():
+        """Return game categories, games satisfying the filters, their
+        facets and their counts by category.
+        """
+        all_categories = GameCategory.query.all()
+        if values is None:
+            return all_categories, [], None, None
+        if game_index and game_index.covers(values):
+            games = find_indexed_games(values)
         else:
-            # Consider game category
-            games = (
-                Game.query.filter(sqlalchemy.text(query).params(param_dict))
-                .filter(Game.categories.any(GameCategory.id == game_category))
-                .all()
-            )
-    return render_template('game-finder.html', games=games,
-                           all_categories=all_categories)
+            games = [game for game, sort_key in filters.search_games(
+                values, filters.default_sort(values))]
+        facets = count_facets(values)
+        return (all_categories, games, facets_dicts(facets),
+                facets['category'])
+
+    return render_template('game-finder.html', search=search,
+                           load_results=load_results)
 
 
 @app.route('/api/games')
+@conditional
+@cached
 def api_games():
     """Return list of games, with all their attributes, satisfying
     the criteria provided in the request query string.
@@ -748,7 +1267,8 @@ def api_games():
         game-attribute type:
             id=INTEGER: value denotes game id,
                 multiple args=YES
-            name=NAME
+            name=NAME: games with names containing all the words of NAME,
+                each word matched as a prefix
             category=INTEGER: value denotes category id,
                 multiple args=YES
             rating-min=[1-10]
@@ -758,66 +1278,143 @@ def api_games():
             time-to=INTEGER
             weight-min=[1-5]
             weight-max=[1-5]
+        paging:
+            sort=KEY: order games by one of filters.SORT_KEYS,
+                prefix with '-' for descending order; default is
+                relevance if name is given and id otherwise
+            limit=INTEGER: maximum number of games in the response
+            after=CURSOR: return games following the cursor; use the URL
+                from the 'next' field of the previous response
+        format:
+            format=json: default; games and the URL of the next page
+            format=ndjson: stream all the games, one JSON object per
+                line, unless limit is given
+            facets=1: also return numbers of all the games satisfying
+                the criteria by category, number of players, weight
+                band and playing time band; json format only
 
     The response is in JSON.
     """
     if not validate_api_game_query(request.args):
         return error_response(
             'One or more query parameters have invalid key and/or value', 400)
-    # Club filter
-    games_club = []
-    if request.args.get('club') == '1':
-        games_club = db_session.query(clubs_games_assoc).all()
-        games_club = [club_game.game_id for club_game in games_club]
-    print 'games_club', games_club
-    # User filter
-    users = [int(user_id) for user_id in request.args.getlist('user')]
-    games_users = db_session.query(users_games_assoc).filter(
-        users_games_assoc.c.user_id.in_(users)).all()
-    games_users = [game.game_id for game in games_users]
-    print 'games_user', games_users
-    # Game attribute filter
-    query = ''
-    param_dict = {}
-    for key, value in request.args.iteritems(multi=True):
-        query, param_dict = game_query_builder(key, value, query, param_dict)
-    query = query[:-5]
-    categories = request.args.getlist('category')
-    if len(categories) == 0:
-        attr_games = Game.query.filter(sqlalchemy.text(query).params(
-            param_dict)).all()
+    # Get games satisfying the search criteria, one page at a time
+    values = filters.parse_args(request.args)
+    sort = request.args.get('sort', filters.default_sort(values))
+    cursor = decode_cursor(request.args['after']) if (
+        'after' in request.args) else None
+    if request.args.get('format') == 'ndjson':
+        # Stream all the games unless limit is given
+        limit = request.args.get('limit', type=int)
+        result = filters.search_rows(values, sort, cursor, limit, stream=True)
+        return Response(stream_with_context(stream_games(result)),
+                        mimetype='application/x-ndjson')
+    limit = int(request.args.get('limit', app.config['API_GAMES_LIMIT']))
+    rows = filters.search_rows(values, sort, cursor, limit + 1).fetchall()
+    next_url = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_url = page_url('after', encode_cursor(
+            [rows[-1]['sort_key'], rows[-1][Game.__table__.c.id]]))
+    games_dict = games_dicts(rows)
+    if request.args.get('facets') == '1':
+        return fast_jsonify(games=games_dict, next=next_url,
+                            facets=facets_dicts(count_facets(values)))
+    return fast_jsonify(games=games_dict, next=next_url)
+
+
+@app.route('/api/planner')
+def api_planner():
+    """Return games playable at a game night.
+
+    A game is playable if it is owned by any of the attendees or the
+    club, supports the number of players and its shortest playing time
+    fits the time budget. Games which can be finished within the budget
+    come first, followed by games which may take longer; games are then
+    ordered by bgg rating.
+
+    Valid query args:
+        user=INTEGER: id of an attendee, multiple args=YES
+        club=1: include games owned by the club
+        players=INTEGER: number of players; defaults to the number of
+            attendees given with the user arg
+        time=INTEGER: time budget in minutes; no limit if not given
+
+    The response is in JSON.
+    """
+    if not validate_api_planner_query(request.args):
+        return error_response(
+            'One or more query parameters have invalid key and/or value', 400)
+    user_ids = [int(user_id) for user_id in request.args.getlist('user')]
+    players = request.args.get('players', len(user_ids), type=int)
+    budget = request.args.get('time', type=int)
+    values = {'players-from': players, 'players-to': players}
+    owners = [('user', user_id) for user_id in user_ids]
+    if user_ids:
+        values['user'] = user_ids
+    if 'club' in request.args:
+        values['club'] = int(request.args['club'])
+        owners.append(('club', values['club']))
+    if budget is not None:
+        values['time-to'] = budget
+    # Find playable games and their owners among the attendees
+    if game_index:
+        games = find_indexed_games(values)
     else:
-        # Consider game categories
-        attr_games = (
-            Game.query.filter(sqlalchemy.text(query).params(param_dict))
-            .filter(Game.categories.any(GameCategory.id.in_(categories))).all()
-        )
-    attr_games = [game.id for game in attr_games]
-    print 'games_query', attr_games
-    # Union of club and user games
-    owned_games = set(games_club) | set(games_users)
-    print 'union', owned_games
-    # Intersection of owned_games and attr_games
-    games_id = ((set(attr_games) & owned_games)
-                if len(owned_games) > 0 else set(attr_games))
-    print 'intersection', games_id
-    # Get all games satisfying the search criteria
-    games = Game.query.filter(Game.id.in_(games_id)).all()
-    games_dict = sql_to_dicts(*games)
-    # Add category info to each game_dict
-    games_categories = {}
+        games = [game for game, sort_key in filters.search_games(values)]
+    game_owners = find_owners([game.id for game in games], owners)
+    names = dict(db_session.query(User.id, User.name).filter(
+        User.id.in_(user_ids))) if user_ids else {}
+    games_dict = []
     for game in games:
-        games_categories[game.id] = [game_category.name for game_category in
-                                     game.categories]
-    for game_dict in games_dict:
-        game_dict['category'] = games_categories[game_dict['id']]
+        game_dict = dict((column.key, getattr(game, column.key))
+                         for column in GAMES_TABLE_COLUMNS)
+        for key, value in game_dict.iteritems():
+            if type(value) == Decimal:
+                game_dict[key] = float(value)
+        game_dict['fits'] = budget is None or (
+            game.max_playtime is not None and game.max_playtime <= budget)
+        game_dict['owners'] = [
+            {'id': owner_id, 'name': names.get(owner_id)}
+            for kind, owner_id in game_owners[game.id] if kind == 'user']
+        game_dict['club'] = any(kind == 'club'
+                                for kind, owner_id in game_owners[game.id])
+        games_dict.append(game_dict)
+    games_dict.sort(key=lambda game_dict: (
+        not game_dict['fits'], -(game_dict['bgg_rating'] or 0),
+        game_dict['id']))
+    return jsonify(players=players, time=budget, games=games_dict)
+
+
+@app.route('/api/games/<int:game_id>/similar')
+def api_similar_games(game_id):
+    """Return games most similar to the game, best first.
+
+    Similarity is based on shared game categories and closeness in
+    complexity and number of players; see boardgameclub.similar.
+
+    The response is in JSON.
+    """
+    if not db_session.query(Game.id).filter_by(id=game_id).scalar():
+        return error_response('Game not found', 404)
+    games_dict = []
+    for row in find_similar_games(game_id):
+        game_dict = dict((key, float(value) if type(value) == Decimal
+                          else value)
+                         for key, value in zip(row.keys(), row))
+        games_dict.append(game_dict)
     return jsonify(games=games_dict)
 
 
 @app.route('/api/info')
+@conditional
+@cached
 def api_info():
     """Return basic information on all sql entries of chosen types.
 
+    Only the requested types are queried, each for the columns listed
+    in INFO_COLUMNS only.
+
     Valid query args:
         users=1
         categories=1
@@ -825,18 +1422,30 @@ def api_info():
 
     The response is in JSON.
     """
-    d = {
-        'users': User.query.all(),
-        'categories': GameCategory.query.all(),
-        'games': Game.query.all()
-    }
     info = {}
     for key, value in request.args.iteritems():
-        if d.get(key) and value == '1':
-            sql_all_dict = sql_to_dicts(*d[key])
-            info[key] = dicts_purge(sql_all_dict,
-                                    *['id', 'name', 'year_published'])
-    return jsonify(**info)
+        if key in INFO_COLUMNS and value == '1':
+            columns = INFO_COLUMNS[key]
+            rows = db_session.execute(
+                sqlalchemy.select(columns).order_by(columns[0]))
+            info[key] = rows_to_dicts(rows, columns)
+    return fast_jsonify(**info)
+
+
+@app.route('/metrics')
+def metrics_():
+    """Return performance metrics in the Prometheus text format.
+
+    Available to club admins and to clients sending the METRICS_TOKEN
+    setting as a bearer token.
+    """
+    user_id = session.get('user_id')
+    token = app.config['METRICS_TOKEN']
+    authorization = request.headers.get('Authorization', '')
+    if not (user_id and is_admin(user_id) or token and hmac.compare_digest(
+            str(authorization), 'Bearer {}'.format(token))):
+        abort(403)
+    return Response(metrics.expose(), mimetype='text/plain; version=0.0.4')
 
 
 @app.route('/gconnect', methods=['POST'])
@@ -857,23 +1466,19 @@ def g_connect():
     except client.FlowExchangeError:
         return error_response('Failed to upgrade one-time authorization code.',
                               401)
-    # Validate id_token
-    if not validate_id_token(credentials.id_token, credentials.id_token_jwt):
+    # Validate id_token; it also holds the user info
+    claims = validate_id_token(credentials.id_token_jwt)
+    if not claims:
         return error_response('id token is not valid', 500)
-    # Get user info from access token
-    userinfo_url = "https://www.googleapis.com/oauth2/v1/userinfo"
-    params = {'access_token': credentials.access_token, 'alt': 'json'}
-    answer = requests.get(userinfo_url, params=params)
-    user_data = answer.json()
     # Store user info in the session for later use
-    session['email'] = credentials.id_token['email']
-    session['username'] = user_data['name']
+    session['email'] = claims['email']
+    session['username'] = claims.get('name', claims['email'])
     session['access_token'] = credentials.access_token
     # If the user does not exist, add him to the database
     session['user_id'], new_user = check_user(
-        session['email'], session['username'],  user_data['picture'])
+        session['email'], session['username'], claims.get('picture'))
     # Response
-    body = {'username': user_data['name'],
+    body = {'username': session['username'],
             'user_id': session['user_id'],
             'new_user': new_user}
     return json_response(body, 200)
@@ -9,13 +9,22 @@ setup(
     entry_points={
         'console_scripts': [
             'bgc_init_db = boardgameclub.scripts.init_db:main',
-            'bgc_add_admin = boardgameclub.scripts.add_admin:main'
+            'bgc_add_admin = boardgameclub.scripts.add_admin:main',
+            'bgc_import_games = boardgameclub.scripts.import_games:main',
+            'bgc_sweep = boardgameclub.scripts.sweep:main',
+            'bgc_seed = boardgameclub.scripts.seed:main'
         ]
     },
     install_requires=[
         'Flask>=1.0.2',
         'oauth2client>=4.1.2',
         'requests>=2.19.1',
+        'rsa>=4.0',
         'SQLAlchemy>=1.2.9'
-    ]
+    ],
+    extras_require={
+        'index': ['numpy>=1.13'],
+        'redis': ['redis>=2.10'],
+        'json': ['ujson>=1.35']
+    }
 )